@@ -3,26 +3,51 @@
 from __future__ import annotations
 
 import argparse
+import contextlib
+import functools
 import os
 import re
 import sqlite3
 import sys
+from collections import deque
 from collections.abc import Iterable, Iterator
+from concurrent.futures import Future, ProcessPoolExecutor
+from operator import itemgetter
 from pathlib import Path
-from typing import Callable, NoReturn, TypeVar
+from typing import Any, Callable, NamedTuple, NoReturn, Protocol, TypeVar
 
-__VERSION__ = 2025_01_21_1
+__VERSION__ = 2026_10_16_1
+
+# Number of rows looked up per query; larger batches improve locality of lookups
+BATCH_SIZE = 100_000
+# Size of read buffers for input files; larger reads reduce syscalls on network FSs
+READ_BUFFER_SIZE = 1024 * 1024
 
 
 RE_SPLIT: re.Pattern[str] = re.compile(r"[_:]")
 
 
+@functools.cache
+def _rsplit_pattern(maxsplit: int) -> re.Pattern[str]:
+    # The greedy prefix ensures that the right-most separators are matched
+    return re.compile("(.*)" + "[_:]([^_:]*)" * maxsplit)
+
+
 def split_key(value: str, *, maxsplit: int = 0) -> list[str]:
     """
-    Split a chr:pos or chr:pos:ref:alt key. Reverse split is used to avoid splitting
-    contig names that contain underscores, such as alt or random sequences.
+    Split a chr:pos or chr:pos:ref:alt key. Keys are split from the right to avoid
+    splitting contig names that contain underscores, such as alt or random sequences.
     """
-    return [it[::-1] for it in reversed(RE_SPLIT.split(value[::-1], maxsplit=maxsplit))]
+    if "_" not in value:
+        # Fast path for the common case where `:` is the only separator
+        return value.rsplit(":", maxsplit or -1)
+    elif maxsplit:
+        match = _rsplit_pattern(maxsplit).fullmatch(value)
+        if match is not None:
+            return list(match.groups())
+
+    # Either no limit or fewer than `maxsplit` separators; every separator is split
+    return RE_SPLIT.split(value)
 
 
 T = TypeVar("T")
@@ -37,83 +62,144 @@ def abort(*args: object) -> NoReturn:
     sys.exit(1)
 
 
-def progress(values: Iterable[T], *, desc: str | None = None) -> Iterable[T]:
+def read_batches(lines: Iterable[str]) -> Iterator[list[str]]:
+    batch: list[str] = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) >= BATCH_SIZE:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+def progress(
+    batches: Iterable[list[T]], *, desc: str | None = None
+) -> Iterator[list[T]]:
+    """Shows progress for batches of values, updating the count once per batch"""
     try:
         import tqdm  # pyright: ignore[reportMissingModuleSource]  # noqa: PLC0415
     except ImportError:
-        return values
+        yield from batches
     else:
-        return tqdm.tqdm(values, unit_scale=True, desc=desc)
+        with tqdm.tqdm(unit_scale=True, desc=desc) as pbar:
+            for batch in batches:
+                pbar.update(len(batch))
+                yield batch
 
 
-def read_identifiers(filepath: Path) -> Iterator[tuple[str, int, str, str, str]]:
-    with filepath.open() as handle:
-        current_chr: str = ""
-        current_pos: int = -1
-        current_alleles: list[tuple[str, str, str]] = []
+class Connection(Protocol):
+    def close(self) -> object: ...
+
+
+class Cursor(Protocol):
+    @property
+    def connection(self) -> Connection: ...
+
+    def execute(self, sql: str, /) -> Iterable[Any]: ...
 
-        def _yield_alleles() -> Iterator[tuple[str, int, str, str, str]]:
-            if current_alleles:
-                current_alleles.sort()
-                iterator = iter(current_alleles)
+    def executemany(self, sql: str, params: Iterable[Any], /) -> object: ...
 
-                last_ref, last_alt, last_value = next(iterator)
-                for ref, alt, value in iterator:
-                    if ref != last_ref or alt != last_alt:
-                        yield current_chr, current_pos, last_ref, last_alt, last_value
-                        last_ref, last_alt, last_value = ref, alt, value
-                    else:
-                        last_value = f"{last_value},{value}"
 
-                yield current_chr, current_pos, last_ref, last_alt, last_value
+def connect(database: Path, *, readonly: bool = False) -> Cursor:
+    """
+    Opens a database using `apsw` if available, falling back to `sqlite3`. In both
+    cases, transactions must be managed manually using BEGIN/COMMIT statements.
+    """
+    try:
+        import apsw  # pyright: ignore[reportMissingImports]  # noqa: PLC0415
+    except ImportError:
+        if readonly:
+            uri = f"file:{database}?mode=ro"
+            con = sqlite3.connect(uri, uri=True, isolation_level=None)
+        else:
+            con = sqlite3.connect(os.fspath(database), isolation_level=None)
+    else:
+        if readonly:
+            flags = apsw.SQLITE_OPEN_READONLY
+        else:
+            flags = apsw.SQLITE_OPEN_READWRITE | apsw.SQLITE_OPEN_CREATE
+
+        con = apsw.Connection(os.fspath(database), flags=flags)
 
-        for line in progress(handle, desc="load "):
-            line = line.strip()
-            if not line:
-                continue
+    return con.cursor()
 
-            position, value = line.split()
-            chrom, position, refs, alts = split_key(position, maxsplit=3)
-            position = int(position)
 
-            # Multiple references per line are not expected, but handled just in case
-            for ref in refs.split(","):
-                if position != current_pos or chrom != current_chr:
-                    yield from _yield_alleles()
+def read_identifiers(filepath: Path) -> Iterator[tuple[str, int, str, str, str]]:
+    # Contig names are shared between rows, rather than allocating one per row. Alleles
+    # are not interned, since the number of unique indels is effectively unbounded
+    contigs: dict[str, str] = {}
 
-                    current_alleles.clear()
-                    current_chr = chrom
-                    current_pos = position
+    with filepath.open(buffering=READ_BUFFER_SIZE) as handle:
+        for lines in progress(read_batches(handle), desc="load "):
+            for line in lines:
+                line = line.strip()
+                if not line:
+                    continue
 
-                for alt in alts.split(","):
-                    current_alleles.append((ref, alt, value))
+                position, value = line.split()
+                chrom, position, refs, alts = split_key(position, maxsplit=3)
+                chrom = contigs.setdefault(chrom, chrom)
+                position = int(position)
 
-        yield from _yield_alleles()
+                # Multiple references per line are not expected, but handled regardless
+                for ref in refs.split(","):
+                    for alt in alts.split(","):
+                        yield chrom, position, ref, alt, value
 
 
 def main_index(database: Path, source: Path) -> int:
-    con = sqlite3.connect(os.fspath(database))
-    cur = con.cursor()
+    cur = connect(database)
 
-    cur.execute("PRAGMA TEMP_STORE=MEMORY;")
+    # Rows are staged in a temporary table and sorted before being added to the index,
+    # both of which may require far more space than is available in memory
+    cur.execute("PRAGMA TEMP_STORE=FILE;")
     cur.execute("PRAGMA JOURNAL_MODE=OFF;")
     cur.execute("PRAGMA SYNCHRONOUS=OFF;")
     cur.execute("PRAGMA LOCKING_MODE=EXCLUSIVE;")
+    # Larger pages/cache reduce B-tree page churn for large indices. Note that the
+    # page size only takes effect if the database is being created
+    cur.execute("PRAGMA PAGE_SIZE=16384;")
+    cur.execute("PRAGMA CACHE_SIZE=-1048576;")  # 1 GiB
 
     cur.execute("DROP TABLE IF EXISTS data;")
+    # Alleles are compared case-insensitively, both when indexing and when querying
     cur.execute(
         "CREATE TABLE data("
         "  chr"
         ", pos INTEGER"
-        ", ref"
-        ", alt"
+        ", ref COLLATE NOCASE"
+        ", alt COLLATE NOCASE"
         ", identifiers"
         ", PRIMARY KEY (chr, pos, ref, alt)"
         ") WITHOUT ROWID;"
     )
+    # Staging table without a primary key, so that loading rows is a simple append
+    cur.execute(
+        "CREATE TEMPORARY TABLE staging("
+        "  chr"
+        ", pos INTEGER"
+        ", ref COLLATE NOCASE"
+        ", alt COLLATE NOCASE"
+        ", identifiers"
+        ");"
+    )
 
-    cur.executemany("INSERT INTO data VALUES(?, ?, ?, ?, ?);", read_identifiers(source))
-
+    cur.execute("BEGIN;")
+    cur.executemany(
+        "INSERT INTO staging VALUES(?, ?, ?, ?, ?);", read_identifiers(source)
+    )
+    # Rows are merged and inserted in key order to fill the B-tree sequentially. The
+    # index sorts rows (once), so that identifiers are also concatenated in order
+    cur.execute("CREATE INDEX staging_key ON staging(chr, pos, ref, alt, identifiers);")
+    cur.execute(
+        "INSERT INTO data "
+        "SELECT chr, pos, ref, alt, group_concat(identifiers, ',') "
+        "FROM staging "
+        "GROUP BY chr, pos, ref, alt;"
+    )
+    cur.execute("DROP TABLE staging;")
     cur.execute("COMMIT;")
     cur.execute("ANALYZE;")
 
@@ -135,15 +221,17 @@ def get_column_indices(keys: dict[str, int], names: list[str]) -> list[int] | No
 def get_combined_key_function(
     keys: dict[str, int],
     key_column: str,
-) -> Callable[[list[str]], tuple[str, int, str, str]]:
+) -> Callable[[str], tuple[str, int, str, str]]:
     column = keys.get(key_column.upper())
     if column is None:
-        if key_column.isdigit():
+        if key_column.isdigit() and int(key_column) > 0:
             column = int(key_column) - 1
         else:
             abort(f"Unknown key column {key_column!r}")
 
-    def _get_primary_key(row: list[str]) -> tuple[str, int, str, str]:
+    def _get_primary_key(line: str) -> tuple[str, int, str, str]:
+        # Columns following the key column are not split
+        row = line.split(None, column + 1)
         values = split_key(row[column], maxsplit=3)
         if len(values) != 4:
             abort("Malformed key; expected 4 values, but found", repr(row[column]))
@@ -157,7 +245,7 @@ def get_combined_key_function(
 def get_primary_key_lookup(
     header: list[str] | None,
     key_column: str | None,
-) -> Callable[[list[str]], tuple[str, int, str, str]]:
+) -> Callable[[str], tuple[str, int, str, str]]:
     keys = {key.upper(): idx for idx, key in enumerate(header or ())}
 
     if key_column is not None:
@@ -170,19 +258,27 @@ def get_primary_key_lookup(
     indices = get_column_indices(keys=keys, names=["CHROM", "POS", "REF", "ALT"])
     if indices is not None:
         chrom, pos, ref, alt = indices
+        # The function is generated with the column indices as constants, which is
+        # faster (~20%) than using indices/an itemgetter stored in a closure
+        namespace: dict[str, Callable[[str], tuple[str, int, str, str]]] = {}
+        exec(  # noqa: S102
+            "def _get_primary_key(line):\n"
+            f"    row = line.split(None, {max(indices) + 1})\n"
+            f"    return (row[{chrom}], int(row[{pos}]), row[{ref}], row[{alt}])\n",
+            namespace,
+        )
 
-        def _get_primary_key(row: list[str]) -> tuple[str, int, str, str]:
-            return (row[chrom], int(row[pos]), row[ref], row[alt])
-
-        return _get_primary_key
+        return namespace["_get_primary_key"]
 
     ####################################################################################
     # Style 2: Combined chr/pos column and individual alt/ref columns
     indices = get_column_indices(keys=keys, names=["MarkerName", "Allele1", "Allele2"])
     if indices is not None:
         chr_pos, ref, alt = indices
+        maxsplit = max(indices) + 1
 
-        def _get_primary_key(row: list[str]) -> tuple[str, int, str, str]:
+        def _get_primary_key(line: str) -> tuple[str, int, str, str]:
+            row = line.split(None, maxsplit)
             values = split_key(row[chr_pos], maxsplit=3)
             if len(values) != 2:
                 abort("Malformed key; expected 4 values, but found", repr(row[chr_pos]))
@@ -198,6 +294,221 @@ def get_primary_key_lookup(
     )
 
 
+def _collect_identifiers(query: Iterable[tuple[int, str]], count: int) -> list[str]:
+    # Results are sorted, so that duplicate IDs (if any) are found in consecutive rows
+    results: list[str] = [""] * count
+    # IDs for keys with more than one unique result are joined once all are collected
+    multiple_results: dict[int, list[str]] = {}
+    last_idx = -1
+    last_identifiers = ""
+    for idx, identifiers in query:
+        if idx != last_idx:
+            results[idx] = identifiers
+        elif identifiers != last_identifiers:
+            values = multiple_results.get(idx)
+            if values is None:
+                values = multiple_results[idx] = [results[idx]]
+
+            values.append(identifiers)
+
+        last_idx = idx
+        last_identifiers = identifiers
+
+    for idx, values in multiple_results.items():
+        results[idx] = ",".join(values)
+
+    return results
+
+
+def lookup_identifiers(
+    cur: Cursor,
+    keys: list[tuple[str, int, str, str]],
+    *,
+    unordered_alleles: bool,
+) -> list[str]:
+    """
+    Looks up identifiers for a batch of keys, returning a comma separated list of
+    unique IDs per key. An empty string is returned for keys without IDs.
+    """
+    rows: list[tuple[int, str, int, str, str]] = []
+    for idx, (chrom, position, ref, alt) in enumerate(keys):
+        rows.append((idx, chrom, position, ref, alt))
+        if unordered_alleles:
+            rows.append((idx, chrom, position, alt, ref))
+
+    # Keys are inserted (and hence scanned) in sorted order, so that lookups move
+    # monotonically through the index, instead of jumping between random pages
+    rows.sort(key=itemgetter(1, 2, 3, 4))
+    cur.executemany("INSERT INTO query VALUES(?, ?, ?, ?, ?);", rows)
+
+    if unordered_alleles:
+        results = _collect_identifiers(
+            cur.execute(
+                "SELECT query.idx, data.identifiers "
+                "FROM query "
+                "JOIN data "
+                "  ON data.chr = query.chr AND data.pos = query.pos "
+                "  AND data.ref = query.ref AND data.alt = query.alt "
+                "ORDER BY query.idx, data.identifiers;"
+            ),
+            len(keys),
+        )
+    else:
+        # Each key matches at most one row, so (idx, IDs) rows are collected as is
+        found: dict[int, str] = dict(
+            cur.execute(
+                "SELECT query.idx, data.identifiers "
+                "FROM query "
+                "JOIN data "
+                "  ON data.chr = query.chr AND data.pos = query.pos "
+                "  AND data.ref = query.ref AND data.alt = query.alt;"
+            )
+        )
+
+        results = [found.get(idx, "") for idx in range(len(keys))]
+
+    cur.execute("DELETE FROM query;")
+
+    return results
+
+
+class LookupOptions(NamedTuple):
+    database: Path
+    header: list[str] | None
+    key_column: str | None
+    missing_value: str
+    unordered_alleles: bool
+
+
+class Lookup:
+    """Adds IDs to batches of lines from a table of variants"""
+
+    def __init__(self, options: LookupOptions) -> None:
+        self._cur = cur = connect(options.database, readonly=True)
+        # Avoid locking/unlocking between queries (2x speedup)
+        cur.execute("PRAGMA LOCKING_MODE=EXCLUSIVE;")
+        # Memory map (up to) 32 GiB of the database to avoid read syscalls
+        cur.execute("PRAGMA MMAP_SIZE=34359738368;")
+        cur.execute("PRAGMA TEMP_STORE=MEMORY;")
+        # Keys are looked up in batches, by joining a temporary table against the index
+        cur.execute(
+            "CREATE TEMPORARY TABLE query("
+            "  idx INTEGER"
+            ", chr"
+            ", pos INTEGER"
+            ", ref COLLATE NOCASE"
+            ", alt COLLATE NOCASE"
+            ");"
+        )
+        # A single transaction is used for all batches; since only the temporary table
+        # is modified, this transaction is never committed
+        cur.execute("BEGIN;")
+
+        self._get_primary_key = get_primary_key_lookup(
+            options.header,
+            key_column=options.key_column,
+        )
+        self._missing_value = options.missing_value
+        self._unordered_alleles = options.unordered_alleles
+
+    def __call__(self, lines: list[str]) -> tuple[str, int, int]:
+        """Returns the output for a batch of lines and the number of found/missing"""
+        get_primary_key = self._get_primary_key
+
+        keys: list[tuple[str, int, str, str]] = []
+        for line in lines:
+            try:
+                key = get_primary_key(line)
+            except IndexError:
+                abort("Malformed key; insufficient number of columns:\n", line)
+            except ValueError:
+                abort("Malformed key; position is not a number:\n", line)
+
+            keys.append(key)
+
+        results = lookup_identifiers(
+            self._cur,
+            keys,
+            unordered_alleles=self._unordered_alleles,
+        )
+
+        # Output is joined once per batch, to minimize per-row overhead
+        records_found = 0
+        output: list[str] = []
+        for line, identifiers in zip(lines, results):
+            if identifiers:
+                records_found += 1
+            else:
+                identifiers = self._missing_value
+
+            output.append(line.rstrip("\r\n"))
+            output.append(" ")
+            output.append(identifiers)
+            output.append("\n")
+
+        return "".join(output), records_found, len(lines) - records_found
+
+
+# Per-process `Lookup` object used by worker processes
+_worker_lookup: Lookup | None = None
+
+
+def _init_worker(options: LookupOptions) -> None:
+    global _worker_lookup  # noqa: PLW0603
+    _worker_lookup = Lookup(options)
+
+
+def _run_worker(lines: list[str]) -> tuple[str, int, int]:
+    if _worker_lookup is None:
+        raise AssertionError("worker process not initialized")
+
+    return _worker_lookup(lines)
+
+
+def lookup_batches(
+    options: LookupOptions,
+    batches: Iterable[list[str]],
+    *,
+    threads: int,
+) -> Iterator[tuple[str, int, int]]:
+    """Looks up batches using one or more processes, yielding results in order"""
+    if threads <= 1:
+        yield from map(Lookup(options), batches)
+        return
+
+    with ProcessPoolExecutor(
+        max_workers=threads,
+        initializer=_init_worker,
+        initargs=(options,),
+    ) as executor:
+        pending: deque[Future[tuple[str, int, int]]] = deque()
+        for batch in batches:
+            # Limit read-ahead to avoid reading the entire input into memory
+            if len(pending) >= 2 * threads:
+                yield pending.popleft().result()
+
+            pending.append(executor.submit(_run_worker, batch))
+
+        while pending:
+            yield pending.popleft().result()
+
+
+def check_index(database: Path) -> None:
+    """Aborts if the index was built without case-insensitive allele columns"""
+    cur = connect(database, readonly=True)
+    query = "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'data';"
+    with contextlib.closing(cur.connection):
+        for (sql,) in cur.execute(query):
+            # Older indices compare alleles case-sensitively, yielding wrong/missing IDs
+            if "COLLATE NOCASE" in sql:
+                return
+
+    abort(
+        f"ERROR: Index {database} is missing or was built by an older version of",
+        "this script; please rebuild it using `--action index`",
+    )
+
+
 def main_lookup(
     *,
     database: Path,
@@ -206,56 +517,34 @@ def main_lookup(
     missing_value: str,
     no_header: bool,
     unordered_alleles: bool,
+    threads: int,
 ) -> int:
-    con = sqlite3.connect(f"file:{database}?mode=ro", uri=True)
-    cur = con.cursor()
-    # Avoid locking/unlocking between queries (2x speedup)
-    cur.execute("PRAGMA LOCKING_MODE=EXCLUSIVE;")
+    check_index(database)
 
-    with source.open() as handle:
+    with source.open(buffering=READ_BUFFER_SIZE) as handle:
         header: list[str] | None = None
         if not no_header:
             header = handle.readline().rstrip("\r\n").split()
             print(*header, "rsID")
 
-        get_primary_key = get_primary_key_lookup(header, key_column=key_column)
+        # Validate the table schema before any worker processes are started
+        get_primary_key_lookup(header, key_column=key_column)
+
+        options = LookupOptions(
+            database=database,
+            header=header,
+            key_column=key_column,
+            missing_value=missing_value,
+            unordered_alleles=unordered_alleles,
+        )
 
         records_found = 0
         records_missing = 0
-        for line in progress(handle, desc="query "):
-            try:
-                chrom, position, ref, alt = get_primary_key(line.split())
-            except IndexError:
-                abort("Malformed key; insufficient number of columns:\n", line)
-            except ValueError:
-                abort("Malformed key; position is not a number:\n", line)
-
-            ref, alt = ref.upper(), alt.upper()
-
-            if unordered_alleles:
-                query = cur.execute(
-                    "SELECT identifiers "
-                    "FROM data "
-                    "WHERE chr = ? AND pos = ? "
-                    "  AND ((ref = ? AND alt = ?) OR (alt = ? AND ref = ?));",
-                    (chrom, int(position), ref, alt, ref, alt),
-                )
-            else:
-                query = cur.execute(
-                    "SELECT identifiers "
-                    "FROM data "
-                    "WHERE chr = ? AND pos = ? AND ref = ? AND alt = ?;",
-                    (chrom, int(position), ref, alt),
-                )
-
-            identifiers = ",".join(sorted({key for (key,) in query}))
-            if identifiers:
-                records_found += 1
-            else:
-                identifiers = missing_value
-                records_missing += 1
-
-            print(line.rstrip("\r\n"), identifiers)
+        batches = progress(read_batches(handle), desc="query ")
+        for output, found, missing in lookup_batches(options, batches, threads=threads):
+            sys.stdout.write(output)
+            records_found += found
+            records_missing += missing
 
     records_total = records_found + records_missing
     records_found_pct = int(1000 * records_found / records_total) / 10  # rounded down
@@ -317,6 +606,12 @@ def build_parser() -> argparse.ArgumentParser:
         " chrom:pos:B:A, i.e. making no assumption about which allele is the reference "
         "allele and which is the alternative allele.",
     )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help="Number of processes used to look up IDs. For lookup only",
+    )
 
     return parser
 
@@ -332,6 +627,7 @@ def main(argv: list[str]) -> int:
     missing_value: str = args.missing_value
     no_header: bool = args.no_header
     unordered_alleles: bool = args.unordered_alleles
+    threads: int = args.threads
 
     if action == "index":
         return main_index(database=database, source=source)
@@ -347,6 +643,7 @@ def main(argv: list[str]) -> int:
             missing_value=missing_value,
             no_header=no_header,
             unordered_alleles=unordered_alleles,
+            threads=threads,
         )
     except BrokenPipeError as error:
         abort("ERROR:", error)
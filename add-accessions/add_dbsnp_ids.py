@@ -0,0 +1 @@
+add-accessions.py
\ No newline at end of file
@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import sqlite3
 import subprocess
 import sys
 from pathlib import Path
@@ -86,6 +87,21 @@ def test_defaults(database: Path) -> None:
     assert lookup(database, args=[], stdin=data_in) == data_out
 
 
+def test_threads(database: Path) -> None:
+    data_in = """CHROM POS REF ALT
+1 10043 T A
+1 10045 C T
+1 10109 A T
+"""
+    data_out = """CHROM POS REF ALT rsID
+1 10043 T A rs1008829651
+1 10045 C T NA
+1 10109 A T rs376007522
+"""
+
+    assert lookup(database, args=["--threads", "2"], stdin=data_in) == data_out
+
+
 def test_no_header_key_column_1(database: Path) -> None:
     data_in = """1:10043:T:A OK bar
 1:10045:C:T Missing bar
@@ -155,3 +171,44 @@ Unknown 2:10800:A:C Chr NA
         lookup(database, args=["--no-header", "--key-column", "2"], stdin=data_in)
         == data_out
     )
+
+
+def test_index_merges_unsorted_identifiers(tmp_path: Path) -> None:
+    database = tmp_path / "index.sqlite3"
+    execute(
+        database,
+        args=["--action", "index"],
+        stdin="1:10055:T:A rs2\n1:10019:TA:T rs775809821\n1:10055:T:A rs1\n",
+    )
+
+    data_in = """CHROM POS REF ALT
+1 10055 T A
+1 10019 TA T
+"""
+    data_out = """CHROM POS REF ALT rsID
+1 10055 T A rs1,rs2
+1 10019 TA T rs775809821
+"""
+
+    assert lookup(database, args=[], stdin=data_in) == data_out
+
+
+def test_lookup_rejects_case_sensitive_index(tmp_path: Path) -> None:
+    database = tmp_path / "index.sqlite3"
+    with sqlite3.connect(database) as con:
+        con.execute(
+            "CREATE TABLE data(chr, pos INTEGER, ref, alt, identifiers, "
+            "PRIMARY KEY (chr, pos, ref, alt)) WITHOUT ROWID;"
+        )
+    con.close()
+
+    proc = subprocess.run(
+        [sys.executable, "add_dbsnp_ids.py", database, "/dev/stdin"],
+        input="CHROM POS REF ALT\n1 100 a g\n",
+        capture_output=True,
+        encoding="utf-8",
+        check=False,
+    )
+
+    assert proc.returncode == 1
+    assert "please rebuild it" in proc.stderr
@@ -5,18 +5,63 @@ import argparse
 import datetime
 import functools
 import grp
+import gzip
+import heapq
+import itertools
 import os
 import pwd
 import shlex
 import shutil
+import signal
 import stat
 import subprocess
 import sys
 from collections import defaultdict
-from collections.abc import Iterable
+from collections.abc import Iterable, Iterator
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Callable, Literal, NamedTuple, NoReturn, TypeAlias
+from types import FrameType
+from typing import (
+    BinaryIO,
+    Callable,
+    Literal,
+    NamedTuple,
+    NoReturn,
+    TypeAlias,
+    get_args,
+)
+
+# Files no larger than this are not compressed in parallel by pigz, which uses 128 KiB
+# blocks, and are therefore compressed in-process to avoid the cost of running pigz
+PIGZ_BLOCK_SIZE = 128 * 1024
+
+# Signatures of file formats that are already compressed; such files are skipped
+# without attempting to compress them (see `is_compressed`)
+COMPRESSED_SIGNATURES = (
+    b"\x1f\x8b",  # gzip, including BGZF (e.g. BAM and tabix indexed) files
+    # bzip2; block size (1-9) followed by the magic number of the first block
+    *(b"BZh%i1AY&SY" % level for level in range(1, 10)),
+    b"\xfd7zXZ\x00",  # xz
+    b"\x28\xb5\x2f\xfd",  # zstd
+    b"PK\x03\x04",  # zip, including xlsx/docx/etc.
+    b"7z\xbc\xaf\x27\x1c",  # 7-zip
+    # CRAM; magic number followed by the major format version
+    b"CRAM\x02",
+    b"CRAM\x03",
+    b"\x89PNG\r\n\x1a\n",  # PNG
+    b"\xff\xd8\xff",  # JPEG
+)
+
+# Local timezone used for timestamps in .archived_by_dap.txt files
+LOCAL_TZ = datetime.datetime.now(datetime.timezone.utc).astimezone().tzinfo
+LOCAL_EPOCH = datetime.datetime.fromtimestamp(0, tz=LOCAL_TZ)
 
 FileStates: TypeAlias = Literal[
     "compressed",
@@ -66,38 +111,68 @@ def cpu_count() -> int:
     return max(1, cpus or 1)
 
 
-def read_file_lists(filepaths: list[Path]) -> Iterable[Path]:
+def read_file_list(filepath: Path) -> Iterator[Path]:
+    with filepath.open(encoding="utf-8", newline="\n") as handle:
+        for line in handle:
+            if (line := line.strip()) and not line.startswith("#"):
+                *_, filename = line.rsplit("\t", 1)
+
+                yield Path(filename)
+
+
+def count_if_sorted(filepath: Path) -> int | None:
+    """Returns the number of paths in a file list, or None if it is not sorted"""
+    count = 0
+    last_path: Path | None = None
+    for path in read_file_list(filepath):
+        if last_path is not None and path < last_path:
+            return None
+
+        last_path = path
+        count += 1
+
+    return count
+
+
+def read_file_lists(filepaths: list[Path]) -> tuple[Iterable[Path], int]:
+    """Returns the sorted paths in the file lists and the total number of paths. Lists
+    are typically already sorted, in which case they are merged without first reading
+    every path into memory."""
+    counts: list[int] = []
     for filepath in filepaths:
-        with filepath.open(encoding="utf-8", newline="\n") as handle:
-            for line in handle:
-                if (line := line.strip()) and not line.startswith("#"):
-                    *_, filename = line.rsplit("\t", 1)
+        count = count_if_sorted(filepath)
+        if count is None:
+            files = sorted(
+                itertools.chain.from_iterable(map(read_file_list, filepaths))
+            )
+            return files, len(files)
+
+        counts.append(count)
 
-                    yield Path(filename)
+    return heapq.merge(*map(read_file_list, filepaths)), sum(counts)
 
 
-def read_file_states(filepath: Path) -> set[Path]:
-    paths: set[Path] = set()
+def read_file_states(filepath: Path) -> set[str]:
+    # Lines are parsed as bytes, so that only the filenames have to be decoded
+    states = frozenset(state.encode("utf-8") for state in get_args(FileStates))
+
+    # Paths are stored as strings, which take up much less memory than Path objects
+    paths: set[str] = set()
     try:
-        with filepath.open(encoding="utf-8", newline="\n") as handle:
+        with filepath.open("rb") as handle:
             for linenum, line in enumerate(handle, start=1):
-                row = line.rstrip("\n").split("\t", 3)
+                row = line.rstrip(b"\n").split(b"\t", 3)
                 if len(row) != 4:
+                    line = line.decode("utf-8", errors="replace")
                     abort(f"Wrong column number on line {linenum}: {line!r}")
 
                 state, _, _, filename = row
-                if state not in (
-                    "compressed",
-                    "filetype",
-                    "hardlinks",
-                    "not_found",
-                    "target_exists",
-                    "incompressible",
-                    "permissions",
-                ):
+                if state not in states:
+                    line = line.decode("utf-8", errors="replace")
+                    state = state.decode("utf-8", errors="replace")
                     abort(f"Invalid state {state!r} on line {linenum}: {line!r}")
 
-                paths.add(Path(filename))
+                paths.add(filename.decode("utf-8"))
     except FileNotFoundError:
         pass
 
@@ -113,48 +188,103 @@ def format_name(func: Callable[[int], str], key: int) -> str:
     return f"{key}/{name}"
 
 
+# Users/groups are listed in bulk, to avoid one NSS (e.g. LDAP) lookup per UID/GID.
+# Users/groups not included in these lists (e.g. if enumeration is disabled) are
+# looked up individually instead
+
+
+@functools.cache
+def user_names() -> dict[int, str]:
+    return {it.pw_uid: it.pw_name for it in pwd.getpwall()}
+
+
+@functools.cache
+def group_names() -> dict[int, str]:
+    return {it.gr_gid: it.gr_name for it in grp.getgrall()}
+
+
 @functools.cache
 def user_name(uid: int) -> str:
-    return format_name(lambda key: pwd.getpwuid(key).pw_name, uid)
+    return format_name(
+        lambda key: user_names().get(key) or pwd.getpwuid(key).pw_name,
+        uid,
+    )
 
 
 @functools.cache
 def group_name(gid: int) -> str:
-    return format_name(lambda key: grp.getgrgid(key).gr_name, gid)
+    return format_name(
+        lambda key: group_names().get(key) or grp.getgrgid(key).gr_name,
+        gid,
+    )
 
 
-def timestamp(value: float) -> str:
-    # Get local timezone
-    tz = datetime.datetime.now(datetime.timezone.utc).astimezone().tzinfo
-    ts = datetime.datetime.fromtimestamp(value, tz=tz)
+def timestamp(value_ns: int) -> str:
+    # Integer timestamps are used, since float timestamps are not precise enough to
+    # represent every microsecond of current dates. LOCAL_TZ is a fixed offset, so
+    # timestamps can be calculated relative to the (local) epoch
+    ts = LOCAL_EPOCH + datetime.timedelta(microseconds=value_ns // 1000)
 
     return ts.isoformat(timespec="microseconds")
 
 
 def stats_to_text(filepath: Path, stats: os.stat_result) -> str:
-    lines: list[str] = [
-        f"filename={filepath}",
-        f"uid={user_name(stats.st_uid)}",
-        f"gid={group_name(stats.st_gid)}",
-        f"mode={stats.st_mode:o}",
-        f"size={stats.st_size}",
-        f"atime={timestamp(stats.st_atime)}",
-        f"mtime={timestamp(stats.st_mtime)}",
-        f"ctime={timestamp(stats.st_ctime)}",
-        "",  # trailing newline
-    ]
+    return (
+        f"filename={filepath}\n"
+        f"uid={user_name(stats.st_uid)}\n"
+        f"gid={group_name(stats.st_gid)}\n"
+        f"mode={stats.st_mode:o}\n"
+        f"size={stats.st_size}\n"
+        f"atime={timestamp(stats.st_atime_ns)}\n"
+        f"mtime={timestamp(stats.st_mtime_ns)}\n"
+        f"ctime={timestamp(stats.st_ctime_ns)}\n"
+    )
 
-    return "\n".join(lines)
 
+# Files are sorted, so files in the same folder are processed in sequence. Listing the
+# folder once is much cheaper than checking for the existence of each target file.
+# Returns None if the folder cannot be listed, e.g. if it is writable but not readable
+@functools.lru_cache(maxsize=256)
+def names_in_folder(folder: Path) -> frozenset[str] | None:
+    try:
+        with os.scandir(folder) as entries:
+            return frozenset(entry.name for entry in entries)
+    except OSError:
+        return None
 
-def process_file(
-    source: Path,
-    pigz: str,
-    threads: int,
-    compression_ratio: float,
-    nth: int,
-    of_n: int,
-) -> tuple[FileStates, int, int]:
+
+def is_compressed(source: Path) -> bool:
+    with source.open("rb") as handle:
+        return handle.read(16).startswith(COMPRESSED_SIGNATURES)
+
+
+def gzip_file(source: Path, stats: os.stat_result, handle_out: BinaryIO) -> None:
+    # Mimics pigz defaults: Compression level 6 and the name/mtime stored in the header
+    with (
+        source.open("rb") as handle_in,
+        gzip.GzipFile(
+            filename=source.name,
+            mode="wb",
+            compresslevel=6,
+            fileobj=handle_out,
+            mtime=int(stats.st_mtime),
+        ) as gzip_out,
+    ):
+        shutil.copyfileobj(handle_in, gzip_out)
+
+
+def compressor_command(compressor: str, threads: int, source: Path) -> list[str | Path]:
+    # libdeflate is single-threaded, but is considerably faster per thread than zlib
+    if Path(compressor).name == "libdeflate-gzip":
+        return [compressor, "-6", "-c", source]
+
+    return [compressor, "--processes", str(threads), "--to-stdout", source]
+
+
+def check_file(source: Path) -> tuple[FileStates, int, int] | os.stat_result:
+    """Returns the stats of a file if it is a candidate for compression, or the state
+    of a file that is to be skipped. These checks are cheap compared to compression and
+    are run before handing the file to a worker, since most files may be skipped."""
     # 1. Verify that the file is a candidate for compression
     try:
         stats = source.lstat()
@@ -179,45 +309,85 @@ def process_file(
     # 2. Verify that the file has not been (partially) processed before
     target = source.parent / f"{source.name}.gz"
     target_txt = source.parent / f"{source.name}.archived_by_dap.txt"
-    if os.path.lexists(target) or os.path.lexists(target_txt):
+    names = names_in_folder(source.parent)
+    if names is None:
+        # Checking individual paths only requires execute permissions for the folder
+        target_exists = os.path.lexists(target) or os.path.lexists(target_txt)
+    else:
+        target_exists = target.name in names or target_txt.name in names
+
+    if target_exists:
         warning("skipping; target already exists:", quote_path(target))
         return ("target_exists", stats.st_size, stats.st_size)
 
-    eprint(f"[{nth:,}/{of_n:,}] Compressing", quote_path(source))
+    return stats
+
+
+def process_file(
+    source: Path,
+    stats: os.stat_result,
+    compressor: str,
+    threads: int,
+    compression_ratio: float,
+    nth: int,
+    of_n: int,
+) -> tuple[FileStates, int, int]:
+    target = source.parent / f"{source.name}.gz"
+    target_txt = source.parent / f"{source.name}.archived_by_dap.txt"
+
+    # Compressing already compressed data only wastes time, since it always fails the
+    # compression ratio check; this is done here, since it requires reading the file
+    if is_compressed(source):
+        warning("skipping already compressed file:", quote_path(source))
+        return ("incompressible", stats.st_size, stats.st_size)
+
     # 3. Create stats file; should not fail, but do it early in case it does; this will
     #    also prevent new attempts on this data, until the stats file has been removed
     stats_txt = stats_to_text(source, stats)
-    with target_txt.open("xt", encoding="utf-8") as handle_out:
-        handle_out.write(stats_txt)
+    try:
+        with target_txt.open("xt", encoding="utf-8") as handle_out:
+            handle_out.write(stats_txt)
+    except FileExistsError:
+        # The folder listing is cached and may therefore be out of date
+        warning("skipping; target already exists:", quote_path(target_txt))
+        return ("target_exists", stats.st_size, stats.st_size)
 
     # 4. Compress to temporary file
     temp_gz = source.parent / f"{source.name}.archived_by_dap.tmp"
     with temp_gz.open("xb") as handle_out:
-        cmd = subprocess.run(
-            [pigz, "--processes", str(threads), "--to-stdout", source],
-            stdout=handle_out,
-            cwd=source.parent,
-            check=False,
-        )
+        if stats.st_size <= PIGZ_BLOCK_SIZE:
+            gzip_file(source, stats, handle_out)
+        else:
+            cmd = subprocess.run(
+                compressor_command(compressor, threads, source),
+                stdout=handle_out,
+                cwd=source.parent,
+                check=False,
+            )
 
-    if cmd.returncode:
-        abort(f"pigz failed with return-code {cmd.returncode}")
+            if cmd.returncode:
+                abort(f"{compressor} failed with return-code {cmd.returncode}")
+
+        # The size is taken from the open handle, to avoid looking up the path again
+        handle_out.flush()
+        size_gz = os.fstat(handle_out.fileno()).st_size
 
     # 5. Check if the compression gains were worthwhile
-    stats_gz = temp_gz.stat()
-    ratio = max(stats_gz.st_size, 1) / max(stats.st_size, 1)
+    ratio = max(size_gz, 1) / max(stats.st_size, 1)
     if ratio > compression_ratio:
         temp_gz.unlink()
         target_txt.unlink()
-        eprint(f"    -> skipped; only compressed to {ratio * 100:.1f}%")
-        return ("incompressible", stats.st_size, stats_gz.st_size)
+        eprint(
+            f"[{nth:,}/{of_n:,}] Skipped; only compressed to {ratio * 100:.1f}%:",
+            quote_path(source),
+        )
+        return ("incompressible", stats.st_size, size_gz)
 
     # 6. Ensure that processed files are in place before unlinking source
     if os.path.lexists(target):
         error("target race condition; skipping: ", quote_path(target))
         return ("target_exists", stats.st_size, stats.st_size)
 
-    eprint(f"    -> compressed to {ratio * 100:.1f}%")
     temp_gz.rename(target)
 
     try:
@@ -228,14 +398,22 @@ def process_file(
         target.unlink()
         return ("permissions", stats.st_size, stats.st_size)
 
-    return ("compressed", stats.st_size, stats_gz.st_size)
+    # A single line is printed per file, since files may be compressed in parallel
+    eprint(
+        f"[{nth:,}/{of_n:,}] Compressed to {ratio * 100:.1f}%:",
+        quote_path(source),
+    )
+
+    return ("compressed", stats.st_size, size_gz)
 
 
 class Args(NamedTuple):
     filelist: list[Path]
     state: Path
     compression_ratio: float
+    compressor: str
     threads: int
+    jobs: int | None
 
 
 def parse_args(argv: list[str]) -> Args:
@@ -261,51 +439,128 @@ def parse_args(argv: list[str]) -> Args:
         help="Compression ratio must be no more than this value, calculated as "
         "compressed_size / original_size. If the size is larger, the file is skipped",
     )
+    parser.add_argument(
+        "--compressor",
+        choices=("pigz", "libdeflate-gzip"),
+        default="pigz",
+        help="Program used for gzip compression. libdeflate-gzip is single-threaded, "
+        "but is faster per thread than pigz",
+    )
     parser.add_argument(
         "--threads",
         type=int,
         default=min(32, cpu_count()),
-        help="Number of threads used for gzip compression",
+        help="Number of threads used for gzip compression; pigz only",
     )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        help="Number of files compressed in parallel. Defaults to the number of "
+        "CPUs divided by --threads",
+    )
+
+    args = Args(**vars(parser.parse_args(argv)))
+    if args.threads < 1:
+        parser.error(f"--threads must be at least 1, not {args.threads}")
+    elif args.jobs is not None and args.jobs < 1:
+        parser.error(f"--jobs must be at least 1, not {args.jobs}")
 
-    return Args(**vars(parser.parse_args(argv)))
+    return args
+
+
+def _on_sigterm(
+    signum: int,  # noqa: ARG001
+    frame: FrameType | None,  # noqa: ARG001
+) -> NoReturn:
+    sys.exit(1)
 
 
 def main(argv: list[str]) -> int:
     args = parse_args(argv)
+    jobs = args.jobs
+    if jobs is None:
+        jobs = max(1, cpu_count() // args.threads)
 
-    pigz_exec = shutil.which("pigz")
-    if pigz_exec is None:
-        sys.exit("ERROR: `pigz` not found on PATH")
+    compressor = shutil.which(args.compressor)
+    if compressor is None:
+        sys.exit(f"ERROR: `{args.compressor}` not found on PATH")
 
     paths = read_file_states(args.state)
 
     processed: dict[FileStates, FileStats] = defaultdict(FileStats)
 
-    with args.state.open("at", encoding="utf-8", newline="\n") as handle:
-        files = sorted(read_file_lists(args.filelist))
-        for nth, filepath in enumerate(files, start=1):
-            if filepath in paths:
-                continue
-
-            if results := process_file(
-                filepath,
-                pigz=pigz_exec,
-                threads=args.threads,
-                compression_ratio=args.compression_ratio,
-                nth=nth,
-                of_n=len(files),
-            ):
-                state, old_size, new_size = results
-
-                proc = processed[state]
-                proc.n += 1
-                proc.size_before += old_size
-                proc.size_after += new_size
-
-                print(state, old_size, new_size, filepath, sep="\t", file=handle)
+    # Exit normally on SIGTERM, so that buffered states are written to the state file
+    signal.signal(signal.SIGTERM, _on_sigterm)
+
+    with args.state.open(
+        "at",
+        buffering=64 * 1024,
+        encoding="utf-8",
+        newline="\n",
+    ) as handle:
+        files, n_files = read_file_lists(args.filelist)
+
+        def _record_result(
+            filepath: Path, state: FileStates, old: int, new: int
+        ) -> None:
+            proc = processed[state]
+            proc.n += 1
+            proc.size_before += old
+            proc.size_after += new
+
+            print(state, old, new, filepath, sep="\t", file=handle)
+            # Skipped files are cheaply re-checked if a run is interrupted, but
+            # compressed files no longer exist and compression is expensive
+            if state in ("compressed", "incompressible"):
                 handle.flush()
 
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            pending: dict[Future[tuple[FileStates, int, int]], Path] = {}
+            last_filepath: Path | None = None
+            try:
+                for nth, filepath in enumerate(files, start=1):
+                    # Duplicates are skipped, since they may otherwise be processed in
+                    # parallel; files are sorted, so duplicates are always consecutive
+                    if str(filepath) in paths or filepath == last_filepath:
+                        continue
+
+                    last_filepath = filepath
+                    stats = check_file(filepath)
+                    if not isinstance(stats, os.stat_result):
+                        _record_result(filepath, *stats)
+                        continue
+
+                    # Wait for a job to finish, to avoid queuing every file up front
+                    if len(pending) >= jobs:
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            _record_result(pending.pop(future), *future.result())
+
+                    future = executor.submit(
+                        process_file,
+                        filepath,
+                        stats,
+                        compressor=compressor,
+                        threads=args.threads,
+                        compression_ratio=args.compression_ratio,
+                        nth=nth,
+                        of_n=n_files,
+                    )
+                    pending[future] = filepath
+
+                for future in as_completed(pending):
+                    _record_result(pending.pop(future), *future.result())
+            finally:
+                # On SIGTERM (or errors), jobs that have not started are cancelled,
+                # but running jobs are allowed to finish, since they unlink their
+                # source files; their results must therefore be recorded
+                for future in pending:
+                    future.cancel()
+
+                for future in as_completed(pending):
+                    if not future.cancelled() and future.exception() is None:
+                        _record_result(pending[future], *future.result())
+
     if sys.stdout.isatty():
         tmpl = "{:<14}  {:>10}  {:>16}  {:>16}  {}".format
 
@@ -68,21 +68,25 @@ def parse_args(argv: list[str]) -> Args:
 def main(argv: list[str]) -> int:
     args = parse_args(argv)
 
-    processed: dict[str, FileStats] = defaultdict(FileStats)
+    # States are read as bytes, to avoid decoding the (unused) paths on every line
+    processed_raw: dict[bytes, FileStats] = defaultdict(FileStats)
     for filepath in args.states:
-        with filepath.open(encoding="utf-8") as handle:
+        with filepath.open("rb") as handle:
             for linenum, line in enumerate(handle, start=1):
-                row = line.rstrip("\n").split("\t", 3)
+                row = line.split(b"\t", 3)
                 if len(row) != 4:
+                    line = line.decode("utf-8", errors="replace")
                     abort(f"Wrong column number on line {linenum}: {line!r}")
 
                 state, size_before, size_after, _ = row
 
-                stats = processed[state]
+                stats = processed_raw[state]
                 stats.n += 1
                 stats.size_before += int(size_before)
                 stats.size_after += int(size_after)
 
+    processed = {key.decode("utf-8"): value for key, value in processed_raw.items()}
+
     to_size = humanize if args.human else str
     if sys.stdout.isatty():
         tmpl = "{:<14}  {:>10}  {:>16}  {:>16}  {}".format
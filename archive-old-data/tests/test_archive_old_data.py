@@ -0,0 +1,64 @@
+from __future__ import annotations
+
+import importlib.util
+import os
+import sys
+from pathlib import Path
+from types import ModuleType
+
+import pytest
+
+SCRIPT = Path(__file__).parent.parent / "archive-old-data.py"
+
+
+@pytest.fixture(scope="module")
+def archive() -> ModuleType:
+    # The script name is not a valid module name and must be loaded from its path
+    spec = importlib.util.spec_from_file_location("archive_old_data", SCRIPT)
+    assert spec is not None
+    assert spec.loader is not None
+
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+
+    return module
+
+
+########################################################################################
+
+
+def test_check_file__unreadable_folder(archive: ModuleType, tmp_path: Path) -> None:
+    # Writable and searchable, but not readable; the folder cannot be listed
+    folder = tmp_path / "folder"
+    folder.mkdir()
+    source = folder / "data.txt"
+    source.write_text("hello world\n" * 1000)
+    (folder / "done.txt").write_text("hello world\n" * 1000)
+    (folder / "done.txt.gz").touch()
+    folder.chmod(0o300)
+
+    try:
+        assert isinstance(archive.check_file(source), os.stat_result)
+        assert archive.check_file(folder / "done.txt")[0] == "target_exists"
+    finally:
+        folder.chmod(0o700)
+
+
+########################################################################################
+
+
+def test_is_compressed__cram(archive: ModuleType, tmp_path: Path) -> None:
+    filepath = tmp_path / "reads.cram"
+    filepath.write_bytes(b"CRAM\x03\x00" + bytes(20))
+
+    assert archive.is_compressed(filepath)
+
+
+def test_is_compressed__text_starting_with_cram(
+    archive: ModuleType, tmp_path: Path
+) -> None:
+    filepath = tmp_path / "notes.txt"
+    filepath.write_text("CRAM files are listed below\n")
+
+    assert not archive.is_compressed(filepath)
@@ -4,8 +4,10 @@ from __future__ import annotations
 
 import argparse
 import functools
+import os
 import shlex
 import sys
+from collections.abc import Iterator
 from pathlib import Path
 
 AUTOFS = {Path("/maps/projects"), Path("/maps/datasets")}
@@ -20,9 +22,10 @@ class Commandline:
     def __str__(self) -> str:
         if self._cmdline is None:
             try:
-                self._cmdline = " ".join(
-                    (self._path / "cmdline").read_text().split("\0")
-                ).strip()
+                cmdline = (self._path / "cmdline").read_bytes()
+                self._cmdline = (
+                    cmdline.replace(b"\0", b" ").decode("utf-8", "replace").strip()
+                )
             except OSError:
                 self._cmdline = ""
 
@@ -72,19 +75,55 @@ def parse_args(argv: list[str]) -> argparse.Namespace:
     return parser.parse_args(argv)
 
 
+def process_dirs(files: list[Path]) -> Iterator[Path]:
+    if files:
+        for it in files:
+            if it.name.isdigit() and it.is_dir():
+                yield it
+    else:
+        # The file type is included in the directory listing, avoiding a stat per entry
+        with os.scandir("/proc") as entries:
+            for entry in entries:
+                if entry.name.isdigit() and entry.is_dir(follow_symlinks=False):
+                    yield Path(entry.path)
+
+
 def main(argv: list[str]) -> int:
     args = parse_args(argv)
 
-    dirs = args.files or Path("/proc").iterdir()
-    for it in dirs:
-        if it.name.isdigit() and it.is_dir():
-            cmdline = Commandline(it)
-            owner = Owner(it)
-
+    for it in process_dirs(args.files):
+        cmdline = Commandline(it)
+        owner = Owner(it)
+
+        try:
+            # Links in /proc point to resolved paths, so there is no need to
+            # resolve every component of the link targets (i.e. `Path.resolve`)
+            cwd = (it / "cwd").readlink()
+        except OSError as error:
+            print(it.name, "ERR", error, file=sys.stderr)
+            continue
+
+        # Crude check since we may not be able to resolve paths to /maps
+        if cwd in AUTOFS or NFSDIRS.intersection(cwd.parts):
+            print(
+                owner,
+                it.name,
+                "CWD",
+                quote(cwd),
+                quote(cmdline),
+                sep="\t",
+            )
+
+        try:
+            with os.scandir(it / "fd") as entries:
+                fds = list(entries)
+        except OSError:
+            continue
+
+        for fd in fds:
             try:
-                cwd = (it / "cwd").resolve()
-            except OSError as error:
-                print(it.name, "ERR", error, file=sys.stderr)
+                cwd = Path(fd.path).readlink()
+            except OSError:
                 continue
 
             # Crude check since we may not be able to resolve paths to /maps
@@ -92,34 +131,12 @@ def main(argv: list[str]) -> int:
                 print(
                     owner,
                     it.name,
-                    "CWD",
+                    f"fd={fd.name}",
                     quote(cwd),
                     quote(cmdline),
                     sep="\t",
                 )
 
-            try:
-                fds = list((it / "fd").iterdir())
-            except OSError:
-                continue
-
-            for fd in fds:
-                try:
-                    cwd = fd.resolve()
-                except OSError:
-                    continue
-
-                # Crude check since we may not be able to resolve paths to /maps
-                if cwd in AUTOFS or NFSDIRS.intersection(fd.parts):
-                    print(
-                        owner,
-                        it.name,
-                        f"fd={fd.name}",
-                        quote(cwd),
-                        quote(cmdline),
-                        sep="\t",
-                    )
-
     return 0
 
 
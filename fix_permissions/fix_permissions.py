@@ -2,19 +2,27 @@
 from __future__ import annotations
 
 import argparse
+import contextlib
 import functools
 import grp
+import io
 import os
 import pwd
 import shlex
 import stat
 import sys
-from collections.abc import Iterable
+from collections.abc import Iterable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
 from typing import NoReturn, TypeVar
 
 T = TypeVar("T")
 
+# Maximum number of open handles for parent folders, one per level of nesting. Entries
+# nested more deeply are accessed using their full path, to avoid running out of file
+# descriptors (EMFILE) when processing very deep trees
+MAX_FOLDER_HANDLES = 64
+
 
 def tqdm(seq: Iterable[T]) -> Iterable[T]:
     if sys.stderr.isatty():
@@ -29,6 +37,8 @@ def tqdm(seq: Iterable[T]) -> Iterable[T]:
 
 
 def warning(*args: object) -> None:
+    # Ensure that (buffered) changes printed so far are shown before the warning
+    sys.stdout.flush()
     print("WARNING:", *args, file=sys.stderr)
 
 
@@ -50,20 +60,45 @@ def get_group_id(name: str) -> int:
     return groupinfo.gr_gid
 
 
+# Users/groups are listed in bulk, to avoid one NSS (e.g. LDAP) lookup per UID/GID.
+# Users/groups not included in these lists (e.g. if enumeration is disabled) are
+# looked up individually instead
+
+
+@functools.cache
+def get_group_names() -> dict[int, str]:
+    return {it.gr_gid: it.gr_name for it in grp.getgrall()}
+
+
+@functools.cache
+def get_user_names() -> dict[int, str]:
+    return {it.pw_uid: it.pw_name for it in pwd.getpwall()}
+
+
+@functools.cache
 def get_group_name(gid: int) -> str:
     try:
-        return grp.getgrgid(gid).gr_name
+        return get_group_names().get(gid) or grp.getgrgid(gid).gr_name
     except KeyError:
         return str(gid)
 
 
+@functools.cache
 def get_user_name(uid: int) -> str:
     try:
-        return pwd.getpwuid(uid).pw_name
+        return get_user_names().get(uid) or pwd.getpwuid(uid).pw_name
     except KeyError:
         return str(uid)
 
 
+def expected_permissions(owner_mode: int, group_mask: int, other_mask: int) -> int:
+    # Group perms same as owner perms, but read-only (by default)
+    group_mode = (owner_mode >> 3) & group_mask
+    other_mode = (owner_mode >> 6) & other_mask
+
+    return owner_mode | group_mode | other_mode
+
+
 def parse_args(argv: list[str]) -> argparse.Namespace:
     parser = argparse.ArgumentParser(
         formatter_class=functools.partial(
@@ -122,30 +157,93 @@ def parse_args(argv: list[str]) -> argparse.Namespace:
         action="store_true",
         help="Do not print changes",
     )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=4,
+        help="Number of threads used to list folders and collect file stats",
+    )
 
-    return parser.parse_args(argv)
+    args = parser.parse_args(argv)
+    if args.threads < 1:
+        parser.error(f"--threads must be at least 1, not {args.threads}")
+
+    return args
+
+
+def list_folder(root: str) -> list[tuple[str, str, os.stat_result]]:
+    # Paths are kept as strings (as provided by scandir) to avoid creating a Path
+    # object for every entry, since they are only passed to `os` functions
+    with os.scandir(root) as entries:
+        return [(it.path, it.name, it.stat(follow_symlinks=False)) for it in entries]
 
 
 def walk(
-    *roots: os.DirEntry[str] | Path,
-) -> Iterable[tuple[Path, Path | os.DirEntry[str], os.stat_result]]:
-    queue = list(roots)
-    while queue:
-        root = queue.pop()
-        if isinstance(root, os.DirEntry):
-            yield Path(root), root, root.stat(follow_symlinks=False)
-        else:
-            yield root, root, os.lstat(root)
-
-        for it in os.scandir(root):
-            if it.is_dir(follow_symlinks=False):
-                yield from walk(it)
-            else:
-                yield Path(it), it, it.stat(follow_symlinks=False)
+    *roots: Path,
+    threads: int,
+) -> Iterator[tuple[str, os.stat_result, int | None, str]]:
+    """Yields (path, stats, dir_fd, name) for every file/folder, where `dir_fd` is an
+    open handle for the parent folder (None for roots), and `name` the path relative
+    to that folder. Using `dir_fd` avoids resolving the full path for every change.
+    Beyond MAX_FOLDER_HANDLES levels of nesting, `dir_fd` is None and `name` is the
+    full path."""
+    # Iterative depth-first walk; entries are pushed in reverse, so that they are
+    # yielded in the order listed, with each folder followed by its contents
+    queue = [(0, str(root), str(root), os.lstat(root)) for root in roots]
+    # Handles for the folders containing the current entry, one per level of nesting
+    folders: list[int] = []
+    # Folders are listed (and their contents stat'ed) ahead of time by worker threads,
+    # since this is dominated by waiting on (network) filesystems. The number of
+    # folders listed ahead of time is limited, to bound memory usage
+    max_pending = threads * 4
+    pending: dict[str, Future[list[tuple[str, str, os.stat_result]]]] = {}
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        try:
+            while queue:
+                depth, filepath, name, stats = queue.pop()
+                while len(folders) > min(depth, MAX_FOLDER_HANDLES):
+                    os.close(folders.pop())
+
+                if folders and depth <= MAX_FOLDER_HANDLES:
+                    yield filepath, stats, folders[-1], name
+                else:
+                    yield filepath, stats, None, name
+
+                if stat.S_ISDIR(stats.st_mode):
+                    entries = None
+                    future = pending.pop(filepath, None)
+                    if future is not None:
+                        # Permissions may have been fixed after the folder was listed
+                        with contextlib.suppress(PermissionError):
+                            entries = future.result()
+
+                    if entries is None:
+                        entries = list_folder(filepath)
+
+                    for it, _, it_stats in entries:
+                        if len(pending) >= max_pending:
+                            break
+                        elif stat.S_ISDIR(it_stats.st_mode):
+                            pending[it] = executor.submit(list_folder, it)
+
+                    if depth < MAX_FOLDER_HANDLES:
+                        folders.append(os.open(filepath, os.O_RDONLY | os.O_DIRECTORY))
+                        queue.extend((depth + 1, *it) for it in reversed(entries))
+                    else:
+                        queue.extend(
+                            (depth + 1, it, it, it_stats)
+                            for it, _, it_stats in reversed(entries)
+                        )
+        finally:
+            for handle in folders:
+                os.close(handle)
 
 
 def main(argv: list[str]) -> int:
     args = parse_args(argv)
+    # Changes are printed in blocks, instead of line by line, when writing to a terminal
+    if isinstance(sys.stdout, io.TextIOWrapper):
+        sys.stdout.reconfigure(line_buffering=False)  # pyright: ignore[reportUnknownMemberType]
 
     gid = get_group_id(args.group)
     uid = os.getuid()
@@ -156,7 +254,22 @@ def main(argv: list[str]) -> int:
     group_mask = 0o070 if args.group_writable else 0o050
     other_mask = 0o005 if args.other else 0o000
 
-    for filepath, direntry, stats in tqdm(walk(*args.root)):
+    # Ensure that group IDs of files are inherited from dirs; if --no-group-bit is set,
+    # existing S_ISGID bits are inherited along with the other special bits
+    folder_group_bit = 0 if args.no_group_bit else stat.S_ISGID
+
+    # The expected mode of every file/folder is calculated ahead of time for every
+    # possible current mode (permissions and special bits), indexed by current mode
+    file_modes: list[int] = []
+    folder_modes: list[int] = []
+    for current_mode in range(0o10000):
+        mode = expected_permissions(current_mode & 0o700, group_mask, other_mask)
+        misc = current_mode & 0o7000
+
+        file_modes.append(mode | misc | min_file_premissions)
+        folder_modes.append(mode | misc | min_folder_premissions | folder_group_bit)
+
+    for filepath, stats, dir_fd, name in tqdm(walk(*args.root, threads=args.threads)):
         if stats.st_uid != uid:
             warning("Path is owned by different user:", quote(filepath))
             continue
@@ -171,37 +284,26 @@ def main(argv: list[str]) -> int:
                 )
 
             if args.commit:
-                os.lchown(filepath, uid, gid)
-
-        if not direntry.is_symlink():
-            # Group perms same as owner perms, but read-only (by default)
-            owner_mode = stats.st_mode & 0o700
-            group_mode = (owner_mode >> 3) & group_mask
-            other_mode = (owner_mode >> 6) & other_mask
-            misc = stats.st_mode & 0o7000
-            mode = owner_mode | group_mode | other_mode | misc
-
-            if direntry.is_dir():
-                mode |= min_folder_premissions
-
-                if args.no_group_bit:
-                    # Inherit S_ISGID
-                    mode = mode | (stats.st_mode & stat.S_ISGID)
-                else:
-                    # Ensure that group IDs of files are inherited from dirs
-                    mode = mode | stat.S_ISGID
+                os.chown(name, uid, gid, dir_fd=dir_fd, follow_symlinks=False)
+
+        # The file type is taken from the `lstat` result, since Path.is_symlink/is_dir
+        # and DirEntry.is_dir (if the FS does not report file types) call `stat`
+        if not stat.S_ISLNK(stats.st_mode):
+            current_mode = stats.st_mode & 0o7777
+            if stat.S_ISDIR(stats.st_mode):
+                mode = folder_modes[current_mode]
             else:
-                mode |= min_file_premissions
+                mode = file_modes[current_mode]
 
-            if stats.st_mode & 0o7777 != mode:
+            if current_mode != mode:
                 if not args.quiet:
                     print(
                         f"chmod {quote(filepath)} to {mode:03o} since mode is "
-                        f"{stats.st_mode & 0o7777:03o}"
+                        f"{current_mode:03o}"
                     )
 
                 if args.commit:
-                    filepath.chmod(mode)
+                    os.chmod(name, mode, dir_fd=dir_fd)
 
     if not args.commit:
         print("Run with --commit to apply changes")
@@ -6,23 +6,27 @@ standalone scripts.
 
 from __future__ import annotations
 
+import functools
 import getpass
-import itertools
-import shlex
 import socket
+import string
 import subprocess
 import tempfile
-from collections.abc import Iterator, Sequence
+from collections.abc import Iterable, Iterator, Sequence
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Generic, Literal, Protocol, TypeVar, cast, overload
 
 __all__ = [
     "SlurmError",
     "sbatch",
+    "sbatch_many",
+    "sbatch_many_script",
     "sbatch_script",
     "slurm_options",
     "srun",
     "srun_command",
+    "submit_scripts",
 ]
 
 # Minimum number of CPUs per job
@@ -32,6 +36,8 @@ MAX_CPUS = 128
 
 MAX_LOW_MEMORY = 2041373 * 1024
 MAX_HIGH_MEMORY = 4015755 * 1024
+# Conversion of memory units to KB, expressed as left-shifts
+_MEMORY_UNIT_SHIFTS = {"K": 0, "M": 10, "G": 20, "T": 30}
 
 # Minimum number of GPUs per job
 MIN_GPUS = 0
@@ -40,6 +46,10 @@ MAX_GPUS = 2
 # The supported GPU types
 GPU_TYPES = ("a100", "h100")
 
+# Maximum number of tasks per job array; Slurm's default MaxArraySize of 1001 limits
+# array indices to the range 0 to 1000
+MAX_ARRAY_SIZE = 1000
+
 # Default `sbatch`/`srun` commands; can be overridden if necessary
 SBATCH_CMD = ("/usr/bin/sbatch",)
 SRUN_CMD = ("/usr/bin/srun",)
@@ -47,7 +57,9 @@ SHELL_CMD = "/bin/bash"
 
 # Some operations can only be performed from the head node (sacct, srun)
 HEAD_NODE = "esrumhead01fl.unicph.domain"
-IS_HEAD_NODE = socket.gethostname() == HEAD_NODE
+
+# Characters that do not require quoting in (bash) shell commands; see `shlex.quote`
+_SAFE_CHARS = frozenset(string.ascii_letters + string.digits + "@%+=:,./-_")
 
 
 _T_out = TypeVar("_T_out", None, str, bytes)
@@ -104,37 +116,27 @@ def slurm_options(
         list[str]: A list of argument that can be passed to sbatch or srun.
 
     """
-    args: list[str] = []
-    if MIN_CPUS <= cpus <= MAX_CPUS:
-        if cpus > 1:
-            args.append(f"--cpus-per-task={cpus}")
-    else:
-        raise ValueError(f"cpus must be in the range {MIN_CPUS}-{MAX_CPUS}, not {cpus}")
-
-    high_memory = False
-    if memory is not None:
-        memory, high_memory = _parse_memory(memory)
-
-        args.append(f"--mem={_to_clean_str(memory)}")
-
-    if gpu_type is not None and gpu_type.lower() not in GPU_TYPES:
-        raise ValueError(f"unknown GPU type {gpu_type!r}")
-    elif MIN_GPUS <= gpus <= MAX_GPUS:
-        if gpus:
-            gpu_request = gpus if gpu_type is None else f"{gpu_type.lower()}:{gpus}"
-            args.append(f"--gres=gpu:{gpu_request}")
-    else:
-        raise ValueError(f"GPUs must be a 0, 1, or 2, not {gpus}")
-
-    if high_memory or gpus:
-        args.append("--partition=gpuqueue")
-
-    if isinstance(mail_user, str) or mail_user:
-        if not isinstance(mail_user, str):
-            mail_user = f"{getpass.getuser()}@ku.dk"
-
-        args.append(f"--mail-user={_to_clean_str(mail_user)}")
-        args.append("--mail-type=END,FAIL")
+    # Fast path for the common case where only default options are used
+    if (
+        cpus == 1
+        and memory is None
+        and gpus == 0
+        and gpu_type is None
+        and mail_user is False
+        and not (job_name or array_params or output_file or extra_args)
+    ):
+        return []
+
+    # Resource options are typically identical across many jobs and are cached
+    args = list(
+        _resource_options(
+            cpus=cpus,
+            memory=memory,
+            gpus=gpus,
+            gpu_type=gpu_type,
+            mail_user=mail_user,
+        )
+    )
 
     if job_name:
         args.append(f"--job-name={_to_clean_str(job_name)}")
@@ -145,11 +147,9 @@ def slurm_options(
     if output_file:
         args.append(f"--output={_to_clean_str(output_file)}")
 
-    for line in extra_args:
-        for it in line.splitlines():
-            it = it.strip()
-            if it:
-                args.append(it)
+    # Arguments may span multiple lines; these are split and empty lines are dropped
+    lines = "\n".join(extra_args).splitlines()
+    args.extend(it for it in map(str.strip, lines) if it)
 
     return args
 
@@ -218,7 +218,10 @@ def sbatch_script(
         f"#!{SHELL_CMD}\n",
     ]
 
-    for line in itertools.chain(args, extra_args):
+    # Options generated above never include the #SBATCH prefix
+    script.extend(f"#SBATCH {line}\n" for line in args)
+
+    for line in extra_args:
         if not line.lstrip().startswith("#SBATCH "):
             line = f"#SBATCH {line}\n"
 
@@ -310,26 +313,231 @@ def sbatch(
         strict=strict,
     )
 
-    with tempfile.NamedTemporaryFile("wt", encoding="utf-8") as handle:
-        handle.writelines(script)
-        handle.flush()
+    return _submit_sbatch_script(script)
 
-        # --parsable ensures that the job ID is easily retrieved
-        with subprocess.Popen(
-            [*SBATCH_CMD, "--parsable", handle.name],
-            shell=False,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        ) as process:
-            stdout, stderr = process.communicate()
 
-    if process.returncode == 0:
-        output = stdout.decode().strip()
-        job_id, *_cluster = output.split(";", 1)
+def sbatch_many_script(
+    commands: Sequence[str] | Sequence[Sequence[str]],
+    *,
+    cpus: int = 1,
+    gpus: int = 0,
+    gpu_type: Literal["a100", "h100", "A100", "H100"] | None = None,
+    memory: int | str | None = None,
+    job_name: str | None = None,
+    modules: SequenceNotStr[str] = (),
+    extra_args: SequenceNotStr[str] = (),
+    output_file: str | Path | None = None,
+    wait: bool = False,
+    mail_user: str | bool = False,
+    strict: bool = True,
+    max_array_size: int = MAX_ARRAY_SIZE,
+) -> list[str]:
+    """Generate sbatch job-array script running each command as a separate task.
 
-        return int(job_id)
+    Args:
+        commands: One or more commands to be run using sbatch, each in its own array
+            task. May be a list of strings, in which case the strings are assumed to be
+            properly formatted commands and included as is, or a list of list of
+            strings, in which case the each list of strings is assumed to represent a
+            single command, and each argument is quoted/escaped to ensure that special
+            characters are properly handled.
+        cpus: The number of CPUs to reserve. Must be a number in the range 1 to 128.
+            Defaults to 1.
+        memory: The amount of memory to reserve. Must be a positive number (in MB) or a
+            string ending with a unit (K, M, G, T). Defaults to ~16G per CPU.
+        gpus: The number of CPUs to reserve, either 0, 1, or 2. Jobs that reserve CPUs
+            will be run on the GPU queue. Defaults to 0.
+        gpu_type: Preferred GPU type, if any, either 'a100' or 'h100'. Defaults to None.
+        job_name: An optional string naming the current Slurm job.
+        modules: A list of zero or more environment modules to load before running the
+            commands specified above. Defaults to ().
+        extra_args: A list of arguments passed directly to srun/sbatch. Multi-part
+            arguments must therefore be split into multiple values:
+            ["--foo", "bar"] and not ["--foo bar"]
+        output_file: Optional name of log-file foom the job.
+        mail_user: Send an email to user on failures or completion of the job. May
+            either be an email address, or `True` to send an email to `$USER@ku.dk`.
+        wait: If true, wait for the job to complete before returning. Defaults to False.
+        strict: If true, the script is configured to terminate on the first error.
+            Defaults to true.
+        max_array_size: The maximum number of tasks in the job array. Slurm rejects
+            arrays larger than its MaxArraySize setting (1001 by default). Defaults
+            to 1000.
 
-    raise SlurmError(stderr.decode().strip())
+    Raises:
+        ValueError: If no commands were given, or if more than `max_array_size`
+            commands were given.
+
+    Returns:
+        list[str]: The sbatch script as a list of strings ending with newlines.
+
+    """
+    if not commands:
+        raise ValueError("no commands given")
+    elif len(commands) > max_array_size:
+        raise ValueError(
+            f"{len(commands)} commands exceeds the maximum job array size of "
+            f"{max_array_size}; use `sbatch_many` to submit multiple job arrays"
+        )
+
+    # Each array task selects its own command based on its index
+    dispatcher = ['case "$SLURM_ARRAY_TASK_ID" in\n']
+    for idx, command in enumerate(_quote_commands(commands)):
+        dispatcher.append(f"{idx})\n{command};;\n")
+    dispatcher.append("*)\n")
+    dispatcher.append('echo >&2 "Unexpected task ID $SLURM_ARRAY_TASK_ID"\n')
+    dispatcher.append("exit 1\n;;\n")
+    dispatcher.append("esac\n")
+
+    return sbatch_script(
+        ["".join(dispatcher)],
+        cpus=cpus,
+        gpus=gpus,
+        gpu_type=gpu_type,
+        memory=memory,
+        job_name=job_name,
+        modules=modules,
+        extra_args=extra_args,
+        output_file=output_file,
+        array_params=f"0-{len(commands) - 1}",
+        wait=wait,
+        mail_user=mail_user,
+        strict=strict,
+    )
+
+
+def sbatch_many(
+    commands: Sequence[str] | Sequence[Sequence[str]],
+    *,
+    cpus: int = 1,
+    gpus: int = 0,
+    gpu_type: Literal["a100", "h100", "A100", "H100"] | None = None,
+    memory: int | str | None = None,
+    job_name: str | None = None,
+    modules: SequenceNotStr[str] = (),
+    extra_args: SequenceNotStr[str] = (),
+    output_file: str | Path | None = None,
+    wait: bool = False,
+    mail_user: str | bool = False,
+    strict: bool = True,
+    max_array_size: int = MAX_ARRAY_SIZE,
+) -> list[str]:
+    """Submit multiple commands as one or more sbatch job-arrays.
+
+    Each command is run as a separate task in an array, which requires only a single
+    call to `sbatch` per array. This is recommended over calling `sbatch` once per
+    command, when submitting more than a handful of jobs. Since Slurm limits the size
+    of job arrays, commands are split into arrays of at most `max_array_size` tasks.
+
+    Args:
+        commands: One or more commands to be run using sbatch, each in its own array
+            task. May be a list of strings, in which case the strings are assumed to be
+            properly formatted commands and included as is, or a list of list of
+            strings, in which case the each list of strings is assumed to represent a
+            single command, and each argument is quoted/escaped to ensure that special
+            characters are properly handled.
+        cpus: The number of CPUs to reserve. Must be a number in the range 1 to 128.
+            Defaults to 1.
+        memory: The amount of memory to reserve. Must be a positive number (in MB) or a
+            string ending with a unit (K, M, G, T). Defaults to ~16G per CPU.
+        gpus: The number of CPUs to reserve, either 0, 1, or 2. Jobs that reserve CPUs
+            will be run on the GPU queue. Defaults to 0.
+        gpu_type: Preferred GPU type, if any, either 'a100' or 'h100'. Defaults to None.
+        job_name: An optional string naming the current Slurm job.
+        modules: A list of zero or more environment modules to load before running the
+            commands specified above. Defaults to ().
+        extra_args: A list of arguments passed directly to srun/sbatch. Multi-part
+            arguments must therefore be split into multiple values:
+            ["--foo", "bar"] and not ["--foo bar"]
+        output_file: Optional name of log-file foom the job.
+        mail_user: Send an email to user on failures or completion of the job. May
+            either be an email address, or `True` to send an email to `$USER@ku.dk`.
+        wait: If true, wait for the job to complete before returning. Defaults to False.
+        strict: If true, the script is configured to terminate on the first error.
+            Defaults to true.
+        max_array_size: The maximum number of tasks per job array. Slurm rejects
+            arrays larger than its MaxArraySize setting (1001 by default). Defaults
+            to 1000.
+
+    Raises:
+        ValueError: If no commands were given, or if `max_array_size` is less than 1.
+        SlurmError: If any job array failed to be submitted. Other job arrays may
+            still have been submitted successfully.
+
+    Returns:
+        list[str]: The JobID of each task, in the same order as `commands`.
+
+    """
+    if not commands:
+        raise ValueError("no commands given")
+    elif max_array_size < 1:
+        raise ValueError(f"max_array_size must be at least 1, not {max_array_size}")
+
+    chunks = [
+        commands[idx : idx + max_array_size]
+        for idx in range(0, len(commands), max_array_size)
+    ]
+
+    scripts = [
+        sbatch_many_script(
+            chunk,
+            cpus=cpus,
+            gpus=gpus,
+            gpu_type=gpu_type,
+            memory=memory,
+            job_name=job_name,
+            modules=modules,
+            extra_args=extra_args,
+            output_file=output_file,
+            wait=wait,
+            mail_user=mail_user,
+            strict=strict,
+            max_array_size=max_array_size,
+        )
+        for chunk in chunks
+    ]
+
+    # Arrays are submitted in parallel, which is also required when waiting for jobs
+    job_ids = submit_scripts(scripts)
+
+    return [
+        f"{job_id}_{idx}"
+        for job_id, chunk in zip(job_ids, chunks)
+        for idx in range(len(chunk))
+    ]
+
+
+def submit_scripts(
+    scripts: Iterable[Sequence[str]],
+    *,
+    max_concurrency: int = 8,
+) -> list[int]:
+    """Submit multiple sbatch scripts, running several `sbatch` commands in parallel.
+
+    This is useful for submitting jobs that require different resources, and that
+    therefore cannot be submitted as a single job-array using `sbatch_many`.
+
+    Args:
+        scripts: One or more sbatch scripts, for example generated using
+            `sbatch_script`, each given as a list of strings ending with newlines.
+        max_concurrency: The maximum number of `sbatch` commands to run at the same
+            time. Defaults to 8.
+
+    Raises:
+        ValueError: If `max_concurrency` is less than 1.
+        SlurmError: If any job failed to be submitted. Other jobs may still have been
+            submitted successfully.
+
+    Returns:
+        list[int]: The JobID of each submitted job, in the same order as `scripts`.
+
+    """
+    if max_concurrency < 1:
+        raise ValueError(f"max_concurrency must be at least 1, not {max_concurrency}")
+
+    # Submission is bound by the latency of slurmctld, not by local work
+    with ThreadPoolExecutor(max_workers=max_concurrency) as pool:
+        return list(pool.map(_submit_sbatch_script, scripts))
 
 
 def srun_command(
@@ -425,6 +633,7 @@ def srun(
     modules: SequenceNotStr[str] = (),
     extra_args: SequenceNotStr[str] = ...,
     capture: Literal[False] = False,
+    detached: Literal[False] = False,
 ) -> SrunResult[None]: ...
 
 
@@ -439,6 +648,7 @@ def srun(
     extra_args: SequenceNotStr[str] = ...,
     capture: Literal[True],
     text: Literal[True] = True,
+    detached: Literal[False] = False,
 ) -> SrunResult[str]: ...
 
 
@@ -453,9 +663,24 @@ def srun(
     extra_args: SequenceNotStr[str] = ...,
     capture: Literal[True],
     text: Literal[False],
+    detached: Literal[False] = False,
 ) -> SrunResult[bytes]: ...
 
 
+@overload
+def srun(
+    command: Sequence[str],
+    *,
+    cpus: int = ...,
+    gpus: int = ...,
+    memory: int | str | None = ...,
+    modules: SequenceNotStr[str] = (),
+    extra_args: SequenceNotStr[str] = ...,
+    capture: Literal[False] = False,
+    detached: Literal[True],
+) -> int: ...
+
+
 def srun(
     command: Sequence[str],
     *,
@@ -467,11 +692,17 @@ def srun(
     capture: bool = False,
     text: bool = True,
     strict: bool = True,
-) -> SrunResult[None] | SrunResult[str] | SrunResult[bytes]:
+    detached: bool = False,
+) -> SrunResult[None] | SrunResult[str] | SrunResult[bytes] | int:
     """Run command via `srun`, and optionally capture its output.
 
     WARNING: This function can only be used from esrumhead01fl!
 
+    Blocking `srun` calls keep a process running on the head node until the command
+    has completed, and should therefore only be used when the output of the command
+    needs to be captured. Otherwise use `detached=True` to submit the command using
+    `sbatch`, in which case the output is written to the default sbatch log-file.
+
     Args:
         command: The command to run, either as a single string that is assumed to
             contain a properly formatted shell command, or as a list of strings, that is
@@ -494,17 +725,40 @@ def srun(
             to strings. Otherwise bytes are returned. Defaults to True.
         strict: If true, the script is configured to terminate on the first error.
             Defaults to true.
+        detached: If true, the command is submitted using `sbatch` and this function
+            returns immediately, without waiting for the command to complete. Cannot
+            be combined with `capture`. Defaults to False.
 
     Raises:
         SlurmError: Raised if this command is invoked on a compute node.
+        ValueError: Raised if both `capture` and `detached` are true.
 
     Returns:
         int: The exit-code from running `srun` (non-zero on error)
         int, str, str: The srun exit-code, stdout, and stderr, if `capture` is True.
         int, bytes, bytes: As above, but `text` is False.
+        int: The JobID of the submitted job, if `detached` is True.
 
     """
-    if not IS_HEAD_NODE:
+    if detached:
+        if capture:
+            raise ValueError("output cannot be captured from detached jobs")
+
+        # sbatch does not require a process on the head node while the job is running
+        script = sbatch_script(
+            commands=[command],
+            cpus=cpus,
+            gpus=gpus,
+            memory=memory,
+            modules=modules,
+            strict=strict,
+        )
+
+        # `extra_args` are command-line arguments for srun (e.g. ["--foo", "bar"]) and
+        # are therefore passed to sbatch on the command-line, not as #SBATCH lines
+        return _submit_sbatch_script(script, extra_args)
+
+    if not _is_head_node():
         raise SlurmError("`srun` can only be called on the head node")
 
     # The user command is wrapped in a script to allow loading of modules
@@ -521,7 +775,8 @@ def srun(
         prefix=".srun_",
         dir=Path.cwd(),
     ) as handle:
-        handle.writelines(script)
+        # Write the script using a single call, rather than one call per line
+        handle.write("".join(script))
         handle.flush()
 
         pipe = subprocess.PIPE if capture else None
@@ -546,6 +801,51 @@ def srun(
     return SrunResult(returncode=process.returncode, stdout=stdout_, stderr=stderr_)
 
 
+def _submit_sbatch_script(
+    script: Sequence[str],
+    extra_args: SequenceNotStr[str] = (),
+) -> int:
+    """Submit an sbatch script and return the resulting JobID."""
+    # --parsable ensures that the job ID is easily retrieved. The script is read from
+    # STDIN when no filename is given, avoiding the need for a temporary file
+    with subprocess.Popen(
+        [*SBATCH_CMD, "--parsable", *extra_args],
+        shell=False,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    ) as process:
+        stdout, stderr = process.communicate("".join(script).encode())
+
+    if process.returncode == 0:
+        output = stdout.decode().strip()
+        job_id, *_cluster = output.split(";", 1)
+
+        return int(job_id)
+
+    raise SlurmError(stderr.decode().strip())
+
+
+@functools.cache
+def _is_head_node() -> bool:
+    """Check if the current host is the Slurm head node."""
+    return socket.gethostname() == HEAD_NODE
+
+
+def __getattr__(name: str) -> bool:
+    """Provide the deprecated `IS_HEAD_NODE` constant, now evaluated on demand."""
+    if name == "IS_HEAD_NODE":
+        return _is_head_node()
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+@functools.cache
+def _default_mail_user() -> str:
+    """Return the default email address for the current user."""
+    return f"{getpass.getuser()}@ku.dk"
+
+
 def _to_clean_str(value: object) -> str:
     """Clean a user-supplied value for use as a CLI argument."""
     svalue = value if isinstance(value, str) else str(value)
@@ -558,6 +858,51 @@ def _to_clean_str(value: object) -> str:
     return svalue
 
 
+@functools.lru_cache(maxsize=128, typed=True)
+def _resource_options(
+    *,
+    cpus: int,
+    memory: int | str | None,
+    gpus: int,
+    gpu_type: Literal["a100", "h100", "A100", "H100"] | None,
+    mail_user: str | bool,
+) -> tuple[str, ...]:
+    """Generate and validate options for requesting resources in `slurm_options`."""
+    args: list[str] = []
+    if MIN_CPUS <= cpus <= MAX_CPUS:
+        if cpus > 1:
+            args.append(f"--cpus-per-task={cpus}")
+    else:
+        raise ValueError(f"cpus must be in the range {MIN_CPUS}-{MAX_CPUS}, not {cpus}")
+
+    high_memory = False
+    if memory is not None:
+        memory, high_memory = _parse_memory(memory)
+
+        args.append(f"--mem={_to_clean_str(memory)}")
+
+    if gpu_type is not None and gpu_type.lower() not in GPU_TYPES:
+        raise ValueError(f"unknown GPU type {gpu_type!r}")
+    elif MIN_GPUS <= gpus <= MAX_GPUS:
+        if gpus:
+            gpu_request = gpus if gpu_type is None else f"{gpu_type.lower()}:{gpus}"
+            args.append(f"--gres=gpu:{gpu_request}")
+    else:
+        raise ValueError(f"GPUs must be a 0, 1, or 2, not {gpus}")
+
+    if high_memory or gpus:
+        args.append("--partition=gpuqueue")
+
+    if isinstance(mail_user, str) or mail_user:
+        if not isinstance(mail_user, str):
+            mail_user = _default_mail_user()
+
+        args.append(f"--mail-user={_to_clean_str(mail_user)}")
+        args.append("--mail-type=END,FAIL")
+
+    return tuple(args)
+
+
 def _parse_memory(value: str | int) -> tuple[str, bool]:
     """Parse, validate, and normalize a `--mem` argument.
 
@@ -575,13 +920,11 @@ def _parse_memory(value: str | int) -> tuple[str, bool]:
     else:
         value_ = _to_clean_str(value).upper()
 
-    if not (value_ and value_[:-1].isdigit() and value_.endswith(("K", "M", "G", "T"))):
+    memory, unit = value_[:-1], value_[-1:]
+    if not (memory.isdigit() and unit in _MEMORY_UNIT_SHIFTS):
         raise ValueError(f"invalid `memory` value {value!r}")
 
-    memory = int(value_[:-1])
-    unit = value_[-1]
-
-    memory_kb = memory * (2 ** {"K": 0, "M": 10, "G": 20, "T": 30}[unit])
+    memory_kb = int(memory) << _MEMORY_UNIT_SHIFTS[unit]
     if memory_kb <= 0:
         raise ValueError(f"non-positive `memory` value {value!r} not allowed")
     elif memory_kb > MAX_HIGH_MEMORY:
@@ -592,14 +935,26 @@ def _parse_memory(value: str | int) -> tuple[str, bool]:
 
 def _quote_commands(
     commands: SequenceNotStr[str] | Sequence[SequenceNotStr[str]],
-) -> Iterator[str]:
+) -> list[str]:
     """Quote and merge arguments in commands given as lists of individual arguments."""
+    result: list[str] = []
     for command in commands:
         if not isinstance(command, str):
             # Ensure that white-space and special characters are correctly quoted
-            command = " ".join(shlex.quote(v) for v in command)
+            command = " ".join(map(_quote, command))
 
         if not command.endswith("\n"):
             command = f"{command}\n"
 
-        yield command
+        result.append(command)
+
+    return result
+
+
+def _quote(value: str) -> str:
+    """Quote a string for use in a shell command; equivalent to `shlex.quote`."""
+    if value and _SAFE_CHARS.issuperset(value):
+        return value
+
+    # Single quotes are placed outside of the single-quoted string: 'a'"'"'b'
+    return "'" + value.replace("'", "'\"'\"'") + "'"
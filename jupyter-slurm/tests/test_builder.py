@@ -4,7 +4,7 @@ import getpass
 from typing import Literal
 
 import pytest
-from jupyter_slurm import sbatch_script, slurm_options, srun_command
+from jupyter_slurm import sbatch_many_script, sbatch_script, slurm_options, srun_command
 
 DEFAULT_EMAIL = f"{getpass.getuser()}@ku.dk"
 
@@ -69,6 +69,49 @@ def test_sbatch_script__modules() -> None:
     ]
 
 
+def test_sbatch_script__quoting() -> None:
+    command = ["echo", "", "a_b", "a b", "it's", "$HOME", "æøå", "--foo=/bar"]
+    assert sbatch_script([command], strict=False) == [
+        "#!/bin/bash\n",
+        "echo '' a_b 'a b' 'it'\"'\"'s' '$HOME' 'æøå' --foo=/bar\n",
+    ]
+
+
+########################################################################################
+# sbatch_many_script
+
+
+def test_sbatch_many_script() -> None:
+    assert sbatch_many_script(["ls", ["echo", "a b"]], strict=False) == [
+        "#!/bin/bash\n",
+        "#SBATCH --array=0-1\n",
+        (
+            'case "$SLURM_ARRAY_TASK_ID" in\n'
+            "0)\n"
+            "ls\n"
+            ";;\n"
+            "1)\n"
+            "echo 'a b'\n"
+            ";;\n"
+            "*)\n"
+            'echo >&2 "Unexpected task ID $SLURM_ARRAY_TASK_ID"\n'
+            "exit 1\n"
+            ";;\n"
+            "esac\n"
+        ),
+    ]
+
+
+def test_sbatch_many_script__no_commands() -> None:
+    with pytest.raises(ValueError, match="no commands given"):
+        sbatch_many_script([])
+
+
+def test_sbatch_many_script__too_many_commands() -> None:
+    with pytest.raises(ValueError, match="exceeds the maximum job array size of 2"):
+        sbatch_many_script(["ls", "ls", "ls"], max_array_size=2)
+
+
 ########################################################################################
 # srun_command
 
@@ -1,21 +1,38 @@
 import unittest.mock
 
+import jupyter_slurm
 import pytest
-from jupyter_slurm import SlurmError, SrunResult, srun
+from jupyter_slurm import (
+    SlurmError,
+    SrunResult,
+    sbatch,
+    sbatch_many,
+    sbatch_script,
+    srun,
+    submit_scripts,
+)
 
 
 def test_srun_on_non_head_node() -> None:
     with (
-        unittest.mock.patch("jupyter_slurm.IS_HEAD_NODE", new=False),
+        unittest.mock.patch("jupyter_slurm._is_head_node", return_value=False),
         unittest.mock.patch("jupyter_slurm.SRUN_CMD", new=("true",)),
         pytest.raises(SlurmError, match="`srun` can only be called on the head"),
     ):
         srun(["ls"])
 
 
+def test_is_head_node_constant() -> None:
+    with unittest.mock.patch("jupyter_slurm._is_head_node", return_value=True):
+        assert jupyter_slurm.IS_HEAD_NODE is True
+
+    with pytest.raises(AttributeError):
+        _ = jupyter_slurm.NOT_AN_ATTRIBUTE
+
+
 def test_srun_on_fake_head_node() -> None:
     with (
-        unittest.mock.patch("jupyter_slurm.IS_HEAD_NODE", new=True),
+        unittest.mock.patch("jupyter_slurm._is_head_node", return_value=True),
         unittest.mock.patch("jupyter_slurm.SRUN_CMD", new=("true",)),
     ):
         srun(["ls"])
@@ -23,7 +40,7 @@ def test_srun_on_fake_head_node() -> None:
 
 def test_srun_capture() -> None:
     with (
-        unittest.mock.patch("jupyter_slurm.IS_HEAD_NODE", new=True),
+        unittest.mock.patch("jupyter_slurm._is_head_node", return_value=True),
         # `nice` is used as safe "fake srun" since it does nothing to the command/output
         unittest.mock.patch("jupyter_slurm.SRUN_CMD", new=("nice",)),
     ):
@@ -48,7 +65,7 @@ def test_srun_capture() -> None:
 
 def test_srun_capture_stderr() -> None:
     with (
-        unittest.mock.patch("jupyter_slurm.IS_HEAD_NODE", new=True),
+        unittest.mock.patch("jupyter_slurm._is_head_node", return_value=True),
         unittest.mock.patch(
             "jupyter_slurm.SRUN_CMD",
             new=("bash", "-c", "echo test failure >&2; exit 13"),
@@ -63,7 +80,100 @@ def test_srun_capture_stderr() -> None:
 
 def test_srun_return_code() -> None:
     with (
-        unittest.mock.patch("jupyter_slurm.IS_HEAD_NODE", new=True),
+        unittest.mock.patch("jupyter_slurm._is_head_node", return_value=True),
         unittest.mock.patch("jupyter_slurm.SRUN_CMD", new=("false",)),
     ):
         assert srun(["my-test"]) == SrunResult(returncode=1, stdout=None, stderr=None)
+
+
+def test_sbatch_script_via_stdin() -> None:
+    with unittest.mock.patch(
+        "jupyter_slurm.SBATCH_CMD",
+        new=("bash", "-c", "grep -qx 'echo my-test' && echo 1234", "sbatch"),
+    ):
+        assert sbatch([["echo", "my-test"]]) == 1234
+
+
+def test_sbatch_many() -> None:
+    with unittest.mock.patch(
+        "jupyter_slurm.SBATCH_CMD",
+        new=("bash", "-c", "echo '1234;cluster'", "sbatch"),
+    ):
+        assert sbatch_many(["ls", "ls", "ls"]) == ["1234_0", "1234_1", "1234_2"]
+
+
+def test_sbatch_many__multiple_arrays() -> None:
+    # The fake JobID of each array is the argument of its first `echo` command
+    with unittest.mock.patch(
+        "jupyter_slurm.SBATCH_CMD",
+        new=("bash", "-c", "sed -n '/^0)$/{n;s/^echo //p}'", "sbatch"),
+    ):
+        commands = [["echo", str(idx)] for idx in range(5)]
+
+        assert sbatch_many(commands, max_array_size=2) == [
+            "0_0",
+            "0_1",
+            "2_0",
+            "2_1",
+            "4_0",
+        ]
+
+
+def test_sbatch_many__invalid_max_array_size() -> None:
+    with pytest.raises(ValueError, match="max_array_size must be at least 1"):
+        sbatch_many(["ls"], max_array_size=0)
+
+
+def test_sbatch_many_failure() -> None:
+    with (
+        unittest.mock.patch(
+            "jupyter_slurm.SBATCH_CMD",
+            new=("bash", "-c", "echo test failure >&2; exit 1", "sbatch"),
+        ),
+        pytest.raises(SlurmError, match="test failure"),
+    ):
+        sbatch_many(["ls", "ls"])
+
+
+def test_srun_detached() -> None:
+    with (
+        unittest.mock.patch("jupyter_slurm._is_head_node", return_value=False),
+        unittest.mock.patch(
+            "jupyter_slurm.SBATCH_CMD",
+            new=("bash", "-c", "echo 1234", "sbatch"),
+        ),
+    ):
+        assert srun(["ls"], detached=True) == 1234
+
+
+def test_srun_detached_extra_args() -> None:
+    # Multi-part arguments must be passed to sbatch as is and not as #SBATCH lines
+    fake_sbatch = '! grep -q "^#SBATCH" && [ "$*" = "--parsable --time 01:00:00" ]'
+    with (
+        unittest.mock.patch("jupyter_slurm._is_head_node", return_value=False),
+        unittest.mock.patch(
+            "jupyter_slurm.SBATCH_CMD",
+            new=("bash", "-c", f"{fake_sbatch} && echo 1234", "sbatch"),
+        ),
+    ):
+        assert srun(["ls"], detached=True, extra_args=["--time", "01:00:00"]) == 1234
+
+
+def test_srun_detached_capture() -> None:
+    with pytest.raises(ValueError, match="output cannot be captured from detached"):
+        srun(["ls"], detached=True, capture=True)  # pyright: ignore[reportCallIssue, reportArgumentType]
+
+
+def test_submit_scripts() -> None:
+    with unittest.mock.patch(
+        "jupyter_slurm.SBATCH_CMD",
+        new=("bash", "-c", "sed -n 's/^echo //p'", "sbatch"),
+    ):
+        scripts = [sbatch_script([["echo", str(idx)]]) for idx in range(20)]
+
+        assert submit_scripts(scripts, max_concurrency=4) == list(range(20))
+
+
+def test_submit_scripts_invalid_concurrency() -> None:
+    with pytest.raises(ValueError, match="max_concurrency must be at least 1"):
+        submit_scripts([], max_concurrency=0)
@@ -4,7 +4,7 @@
 # dependencies = [
 #     "coloredlogs==15.0.1",
 #     "koda-validate==4.1.1",
-#     "tomli==2.0.1",
+#     "tomli==2.0.1; python_version < '3.11'",
 #     "typing-extensions==4.11.0",
 # ]
 # ///
@@ -16,18 +16,23 @@ import functools
 import json
 import logging
 import os
+import stat
 import subprocess
 import sys
-from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from dataclasses import dataclass
 from datetime import datetime
 from pathlib import Path
 from typing import Literal, NoReturn
 
 import coloredlogs
-import tomli
 from koda_validate import DataclassValidator, Valid
 
+if sys.version_info >= (3, 11):
+    import tomllib
+else:
+    import tomli as tomllib
+
 _LOG = logging.getLogger("monitor-sinfo")
 
 _debug = _LOG.debug
@@ -36,6 +41,9 @@ _info = _LOG.info
 _warning = _LOG.warning
 _log = _LOG.log
 
+# Units used by `format_size`, from largest to smallest
+_SIZE_UNITS = ((1024**4, "TB"), (1024**3, "GB"), (1024**2, "MB"), (1024, "KB"))
+
 
 def abort(msg: str, *values: object) -> NoReturn:
     _error(msg, *values)
@@ -43,9 +51,9 @@ def abort(msg: str, *values: object) -> NoReturn:
 
 
 def format_size(size: int, *, delta: bool = False) -> str:
-    for nth, label in ((4, "TB"), (3, "GB"), (2, "MB"), (1, "KB")):
-        if size >= 1024**nth:
-            pct = size / 1024**nth
+    for unit, label in _SIZE_UNITS:
+        if size >= unit:
+            pct = size / unit
             return f"{pct:+.1f} {label}" if delta else f"{pct:.1f} {label}"
 
     return f"{size:+} B" if delta else f"{size} B"
@@ -128,7 +136,7 @@ class Config:
     @staticmethod
     def load(filepath: Path) -> Config:
         with filepath.open("rb") as handle:
-            toml: object = tomli.load(handle)
+            toml: object = tomllib.load(handle)
 
         validator = DataclassValidator(Config)
         result = validator(toml)
@@ -154,14 +162,15 @@ class Result:
                 size = handle.tell()
                 handle.seek(-min(size, 1024), os.SEEK_END)
 
-                lines = handle.readlines()
+                tail = handle.read()
         except FileNotFoundError:
             return None
 
-        if not lines:
+        if not tail:
             return None
 
-        record = json.loads(lines[-1])
+        # The last line, excluding any trailing newline
+        record = json.loads(tail[tail.rfind(b"\n", 0, -1) + 1 :])
         validator = DataclassValidator(Result)
         result = validator(record)
         if not isinstance(result, Valid):
@@ -174,25 +183,73 @@ class Result:
             print(json.dumps(vars(self)), file=handle)
 
 
-def count_files(root: Path, expected: set[Path]) -> Result:
+def count_folder(
+    path: str,
+    size: int,
+    prefix_len: int,
+    expected: set[str],
+) -> tuple[int, int, int, list[tuple[str, int]]]:
+    items = found = total_size = 0
+    folders: list[tuple[str, int]] = []
+
+    # `DirEntry` caches file types and `lstat` results, unlike `Path.iterdir`
+    with contextlib.suppress(OSError), os.scandir(path) as entries:
+        # The size of a folder is only counted if it can be listed
+        total_size += size
+
+        for entry in entries:
+            items += 1
+            if entry.path[prefix_len:] in expected:
+                found += 1
+
+            with contextlib.suppress(OSError):
+                entry_stat = entry.stat(follow_symlinks=False)
+                if entry.is_dir(follow_symlinks=False):
+                    folders.append((entry.path, entry_stat.st_size))
+                else:
+                    total_size += entry_stat.st_size
+
+    return items, total_size, found, folders
+
+
+def count_files(root: Path, expected: set[str], threads: int) -> Result:
     result = Result(timestamp=datetime.now().isoformat())  # noqa: DTZ005
     result.expected = len(expected)
     result.found = 0
 
-    queue: deque[Path] = deque([root])
-    while queue:
-        it = queue.popleft()
+    # Relative paths are compared as strings, to avoid creating a `Path` per entry
+    prefix_len = len(str(root).rstrip(os.sep)) + 1
 
-        with contextlib.suppress(OSError):
-            if not it.is_symlink() and it.is_dir():
-                queue.extend(it.iterdir())
+    result.items += 1
+    if os.curdir in expected:
+        result.found += 1
 
-            stat = it.lstat()
-            result.size += stat.st_size
-
-        result.items += 1
-        if it.relative_to(root) in expected:
-            result.found += 1
+    folders: list[tuple[str, int]] = []
+    with contextlib.suppress(OSError):
+        root_stat = root.lstat()
+        if stat.S_ISDIR(root_stat.st_mode):
+            folders.append((str(root), root_stat.st_size))
+        else:
+            result.size += root_stat.st_size
+
+    # Folders are listed in parallel, to overlap the latency of (network) filesystems
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending: set[Future[tuple[int, int, int, list[tuple[str, int]]]]] = set()
+        while folders or pending:
+            for path, size in folders:
+                pending.add(
+                    executor.submit(count_folder, path, size, prefix_len, expected)
+                )
+
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+            folders = []
+            for future in done:
+                items, size, found, subfolders = future.result()
+                result.items += items
+                result.size += size
+                result.found += found
+                folders.extend(subfolders)
 
     return result
 
@@ -209,6 +266,7 @@ class Args:
     config: Path
     expected: Path | None
     log_level: Literal["DEBUG", "INFO", "WARNING", "ERROR"]
+    threads: int
 
 
 def parse_args(argv: list[str]) -> Args:
@@ -238,8 +296,18 @@ def parse_args(argv: list[str]) -> Args:
         choices=("DEBUG", "INFO", "WARNING", "ERROR"),
         help="Verbosity level for console logging",
     )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=8,
+        help="Number of threads used to list folders",
+    )
 
-    return Args(**vars(parser.parse_args(argv)))
+    args = Args(**vars(parser.parse_args(argv)))
+    if args.threads < 1:
+        parser.error(f"--threads must be at least 1, not {args.threads}")
+
+    return args
 
 
 def main(argv: list[str]) -> int:
@@ -249,17 +317,22 @@ def main(argv: list[str]) -> int:
 
     setup_logging(args)
 
-    expected: set[Path] = set()
+    expected: set[str] = set()
     if args.expected is not None:
-        with args.expected.open() as handle:
-            for line in handle:
-                path = Path(line.strip())
-                if path.is_absolute():
-                    abort(f"Path in {args.expected} is absolute: {path}")
-
-                expected.add(path)
-
-    result = count_files(root=Path(config.root), expected=expected)
+        # Normalized to match the relative paths generated by `count_files`
+        lines = args.expected.read_text().splitlines()
+        paths = [os.path.normpath(line.strip()) for line in lines]
+        for path in paths:
+            if path.startswith(os.sep):
+                abort(f"Path in {args.expected} is absolute: {path}")
+
+        expected = set(paths)
+
+    result = count_files(
+        root=Path(config.root),
+        expected=expected,
+        threads=args.threads,
+    )
     if args.expected is None:
         result.expected = None
 
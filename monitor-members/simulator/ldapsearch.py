@@ -8,6 +8,7 @@ import random
 import re
 import string
 import sys
+from itertools import product
 from pathlib import Path
 from typing import NoReturn, TypedDict
 
@@ -173,31 +174,22 @@ def new_username(rng: random.Random) -> str:
     return "".join(username)
 
 
-def new_display_name(rng: random.Random) -> str:
-    return f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}"
-
-
 def read_cache(path: Path, rng: random.Random) -> Cache:
     try:
         with path.open(encoding="utf-8") as handle:
             return json.load(handle)
     except FileNotFoundError:
-        cache: Cache = {"users": {}, "groups": {}}
-        display_names: set[str] = set()
-
-        for _ in range(_N_USERS):
-            username = new_username(rng)
-            while username in cache["users"]:
-                username = new_username(rng)
+        # Usernames are practically never repeated, unlike the ~4000 display names
+        usernames: dict[str, None] = {}
+        while len(usernames) < _N_USERS:
+            usernames[new_username(rng)] = None
 
-            display_name = new_display_name(rng)
-            while display_name in display_names:
-                display_name = new_display_name(rng)
+        display_names = rng.sample(
+            [f"{first} {last}" for first, last in product(FIRST_NAMES, LAST_NAMES)],
+            k=_N_USERS,
+        )
 
-            display_names.add(display_name)
-            cache["users"][username] = display_name
-
-        return cache
+        return {"users": dict(zip(usernames, display_names)), "groups": {}}
 
 
 def write_cache(path: Path, cache: Cache) -> None:
@@ -235,13 +227,19 @@ def main(argv: list[str]) -> int:
 
     new_group = [user for user in group if rng.random() > _CHANCE_REMOVE]
 
+    group_set = set(group)
+    choices = [user for user in users if user not in group_set]
     while rng.random() <= _CHANCE_ADD:
-        choices = tuple(set(users) - set(group))
         if choices:
-            new_group.append(rng.choice(choices))
-
-    for member in sorted(new_group):
-        print(f"member: CN={member},OU=Active,OU=KU Users,DC=unicph,DC=domain")
+            # Swap the chosen user with the last user, so that it can be removed cheaply
+            idx = rng.randrange(len(choices))
+            choices[idx], choices[-1] = choices[-1], choices[idx]
+            new_group.append(choices.pop())
+
+    sys.stdout.writelines(
+        f"member: CN={member},OU=Active,OU=KU Users,DC=unicph,DC=domain\n"
+        for member in sorted(new_group)
+    )
 
     cache["groups"][key] = new_group
 